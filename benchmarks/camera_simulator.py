@@ -0,0 +1,375 @@
+"""Local stand-in for a Hikvision PTZ camera, for tests and load runs.
+
+Serves the ISAPI endpoints HikvisionDriver uses (Image Color, Gain,
+Sharpness, Shutter, WhiteBlance and powerLineFrequency, PTZCtrl status,
+absolute and home position, Streaming/channels), starting from the documents
+in benchmarks/responses. PUTs update the documents, and PTZ moves take time,
+like a real camera. Every ISAPI call can be delayed (--latency, --jitter) and
+fail with an HTTP error (--error-rate, --error-status).
+
+Video comes from a file (or synthetic frames), in a loop at --fps, as an
+MJPEG stream over HTTP at /Streaming/channels/101/httpPreview (which OpenCV
+and PyAV read like the RTSP stream; point the driver's stream.url at it) and
+as snapshots at /Streaming/channels/101/picture. Paths may also start with
+/ISAPI.
+
+Stream outages are simulated with CameraSimulator.outage() or a GET on
+/sim/outage?seconds=S&mode=M: 'drop' closes the streams and refuses new
+ones, 'stall' keeps the connections open but stops sending frames.
+
+Usage: python camera_simulator.py [--port 8080] [--video FILE] [--width W]
+                                  [--height H] [--fps F] [--quality Q]
+                                  [--latency S] [--jitter S] [--error-rate X]
+                                  [--error-status N] [--ptz-speed N]
+"""
+import argparse
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BOUNDARY = "hikvisionsimulator"
+_FIELD = re.compile(rb"<(\w+)>([^<]*)</\1>")
+
+
+class FrameSource(object):
+    # Encodes one JPEG per frame interval, shared by every client.
+    def __init__(self, video=None, width=1280, height=720, fps=30.0, quality=80):
+        self.video = video
+        self.width = width
+        self.height = height
+        self.interval = 1.0 / fps
+        self.quality = quality
+        self.jpeg = None
+        self.sequence = 0
+        self.run = True
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._producer, name="frames", daemon=True)
+        self.t.start()
+
+    def _frames(self):
+        if self.video is None:
+            background = np.full((self.height, self.width, 3), 96, np.uint8)
+            cv2.putText(background, "camera simulator", (20, 60), cv2.FONT_HERSHEY_SIMPLEX,
+                        1.5, (255, 255, 255), 3)
+            size = self.height // 6
+            i = 0
+            while True:
+                frame = background.copy()
+                x = (i * 8) % (self.width - size)
+                cv2.rectangle(frame, (x, self.height // 3), (x + size, self.height // 3 + size),
+                              (40, 200, 40), -1)
+                yield frame
+                i += 1
+        cap = cv2.VideoCapture(self.video)
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = cap.read()
+                if not ok:
+                    raise IOError("Couldn't read {}".format(self.video))
+            yield frame
+
+    def _producer(self):
+        next_frame = time.time()
+        for frame in self._frames():
+            if not self.run:
+                break
+            if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+            _, jpeg = cv2.imencode(".jpeg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            with self.cond:
+                self.jpeg = jpeg.tobytes()
+                self.sequence += 1
+                self.cond.notify_all()
+            next_frame = max(next_frame + self.interval, time.time())
+            time.sleep(max(0.0, next_frame - time.time()))
+
+    def resize(self, width, height):
+        self.width, self.height = width, height
+
+    def next(self, sequence, timeout=5.0):
+        # The first frame newer than 'sequence'.
+        with self.cond:
+            self.cond.wait_for(lambda: self.sequence > sequence or not self.run, timeout)
+            return self.sequence, self.jpeg
+
+    def stop(self):
+        self.run = False
+
+
+class CameraState(object):
+    # ISAPI documents by path, and the PTZ, which moves toward its target at
+    # 'ptz_speed' units (tenths of degree, zoom steps) per second.
+    def __init__(self, ptz_speed=600.0):
+        self.documents = {}
+        for name in os.listdir(os.path.join(HERE, "responses")):
+            with open(os.path.join(HERE, "responses", name), "rb") as f:
+                self.documents[name[:-len(".xml")]] = f.read()
+        self.ptz_speed = ptz_speed
+        self.position = self._position()
+        self.home = self.position
+        self.target = self.position
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _position(self):
+        fields = dict(_FIELD.findall(self.documents["PTZStatus"]))
+        return [float(fields[b"azimuth"]), float(fields[b"elevation"]),
+                float(fields[b"absoluteZoom"])]
+
+    def document(self, name):
+        with self.lock:
+            if name == "PTZStatus":
+                self._move()
+            return self.documents.get(name)
+
+    def update(self, name, body):
+        # Leaf values in 'body' replace the same elements in the document.
+        with self.lock:
+            document = self.documents.get(name)
+            if document is None:
+                self.documents[name] = body
+                return
+            for field, value in _FIELD.findall(body):
+                document = re.sub(b"<" + field + b">[^<]*</" + field + b">",
+                                  b"<" + field + b">" + value + b"</" + field + b">", document)
+            self.documents[name] = document
+
+    def move_to(self, target=None):
+        with self.lock:
+            self._move()
+            self.target = list(target) if target is not None else list(self.home)
+
+    def _move(self):
+        now = time.time()
+        step = self.ptz_speed * (now - self.updated)
+        self.updated = now
+        for axis in range(3):
+            delta = self.target[axis] - self.position[axis]
+            self.position[axis] += max(-step, min(step, delta))
+        azimuth, elevation, zoom = (str(int(round(value))).encode() for value in self.position)
+        document = self.documents["PTZStatus"]
+        for field, value in ((b"azimuth", azimuth), (b"elevation", elevation), (b"absoluteZoom", zoom)):
+            document = re.sub(b"<" + field + b">[^<]*</" + field + b">",
+                              b"<" + field + b">" + value + b"</" + field + b">", document)
+        self.documents["PTZStatus"] = document
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    DOCUMENTS = ("Color", "Gain", "Sharpness", "Shutter", "WhiteBlance", "powerLineFrequency")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        path = self.path.partition("?")[0]
+        if path.startswith("/ISAPI/"):
+            path = path[len("/ISAPI"):]
+        return path
+
+    def _reply(self, status, body=b"", content_type="application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ok(self):
+        self._reply(200, self.server.state.documents["ResponseStatus"])
+
+    def _injected(self):
+        # Applies the configured latency and, sometimes, fails the call.
+        simulator = self.server.simulator
+        delay = simulator.latency + random.uniform(0, simulator.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        simulator.requests += 1
+        if random.random() < simulator.error_rate:
+            simulator.errors += 1
+            self._reply(simulator.error_status)
+            return True
+        return False
+
+    def _document_name(self, path):
+        if path.startswith("/PTZCtrl/") and path.endswith("/status"):
+            return "PTZStatus"
+        if re.match(r"^/Streaming/channels/\d+$", path):
+            return "StreamingChannel"
+        for name in self.DOCUMENTS:
+            if path.startswith("/Image/") and path.endswith("/" + name):
+                return name
+        return None
+
+    def do_GET(self):
+        path = self._path()
+        if path == "/sim/outage":
+            query = dict(item.split("=", 1) for item in self.path.partition("?")[2].split("&") if item)
+            self.server.simulator.outage(float(query.get("seconds", 5)), query.get("mode", "drop"))
+            return self._reply(200, b"", "text/plain")
+        if path.endswith("/httpPreview"):
+            return self._stream()
+        if self._injected():
+            return
+        if path.endswith("/picture"):
+            if self.server.simulator.stream_down():
+                return self._reply(503)
+            _, jpeg = self.server.frames.next(0)
+            return self._reply(200, jpeg, "image/jpeg")
+        name = self._document_name(path)
+        if name is None:
+            return self._reply(404)
+        self._reply(200, self.server.state.document(name))
+
+    def do_PUT(self):
+        path = self._path()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self._injected():
+            return
+        state = self.server.state
+        if path.endswith("/homeposition/goto"):
+            state.move_to(None)
+        elif path.startswith("/PTZCtrl/") and path.endswith("/absolute"):
+            fields = dict(_FIELD.findall(body))
+            state.move_to([float(fields[b"azimuth"]), float(fields[b"elevation"]),
+                           float(fields[b"absoluteZoom"])])
+        else:
+            name = self._document_name(path)
+            if name is None:
+                return self._reply(404)
+            state.update(name, body)
+            if name == "StreamingChannel":
+                fields = dict(_FIELD.findall(body))
+                if b"videoResolutionWidth" in fields and b"videoResolutionHeight" in fields:
+                    self.server.frames.resize(int(fields[b"videoResolutionWidth"]),
+                                              int(fields[b"videoResolutionHeight"]))
+        self._ok()
+
+    def _stream(self):
+        simulator = self.server.simulator
+        if simulator.stream_down():
+            return self._reply(503)
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=" + BOUNDARY)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        simulator.streams += 1
+        sequence = 0
+        try:
+            while simulator.run:
+                if simulator.stream_down():
+                    if simulator.outage_mode == "drop":
+                        break
+                    time.sleep(0.05)
+                    continue
+                sequence, jpeg = self.server.frames.next(sequence)
+                self.wfile.write("--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n"
+                                 .format(BOUNDARY, len(jpeg)).encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            pass
+        finally:
+            simulator.streams -= 1
+
+
+class CameraSimulator(object):
+    # Runs the simulator in background threads; 'port' 0 picks a free port.
+    def __init__(self, port=0, video=None, width=1280, height=720, fps=30.0, quality=80,
+                 latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, ptz_speed=600.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+        self.outage_mode = "drop"
+        self.outage_until = 0.0
+        self.run = True
+        self.frames = FrameSource(video, width, height, fps, quality)
+        self.state = CameraState(ptz_speed)
+        self.server = ThreadingHTTPServer(("127.0.0.1" if port == 0 else "", port), SimulatorHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.server.frames = self.frames
+        self.server.state = self.state
+        self.port = self.server.server_address[1]
+        self.t = threading.Thread(target=self.server.serve_forever, name="simulator", daemon=True)
+        self.t.start()
+
+    def outage(self, seconds, mode="drop"):
+        self.outage_mode = mode
+        self.outage_until = time.time() + seconds
+
+    def stream_down(self):
+        return time.time() < self.outage_until
+
+    def stream_url(self, channel=101):
+        return "http://127.0.0.1:{}/Streaming/channels/{}/httpPreview".format(self.port, channel)
+
+    def camera_config(self, **stream):
+        # The 'camera' section of the gateway's configuration, pointing at
+        # this simulator.
+        config = {
+            "id": "sim", "ip": "127.0.0.1", "rtsp_port": 554, "http_port": self.port,
+            "username": "admin", "password": "admin",
+            "isapi": {"auth": "basic", "timeout": 2.0},
+            "stream": {"channel_id": 1, "stream_id": 1, "compress_standart": "MJPEG",
+                       "width": self.frames.width, "height": self.frames.height,
+                       "fps": 1.0 / self.frames.interval, "url": self.stream_url()},
+            "image": {"format": "JPEG", "compression": 0.8},
+            "ptz": {"poll_fast": 0.05},
+        }
+        config["stream"].update(stream)
+        return config
+
+    def stop(self):
+        self.run = False
+        self.frames.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--video", help="video file to stream (default: synthetic frames)")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality of the stream")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to ISAPI calls")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency, up to")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of ISAPI calls failed")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--ptz-speed", type=float, default=600.0, help="PTZ units per second")
+    args = parser.parse_args()
+
+    simulator = CameraSimulator(args.port, args.video, args.width, args.height, args.fps,
+                                args.quality, args.latency, args.jitter, args.error_rate,
+                                args.error_status, args.ptz_speed)
+    print("ISAPI on http://127.0.0.1:{}, stream at {}".format(simulator.port, simulator.stream_url()))
+    try:
+        while True:
+            time.sleep(10)
+            print("requests {} errors {} streams {}".format(
+                simulator.requests, simulator.errors, simulator.streams))
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""Python-side memory allocated per frame on the capture -> encode -> publish
+path, measured with tracemalloc, for the previous path and the current one.
+
+Frames come from camera_simulator.py, run in a separate process, as a live
+MJPEG stream. The current path is the driver's own code: frames are read with
+camera_driver.capture.VideoCapture (decoded into its BufferRing), encoded by
+EncoderPool as the gateway does and wrapped in a message body in one copy.
+The previous path decodes every frame into a new array and copies the
+encoded buffer into an Image and again into the body. The script exits with
+an error when the current path's peak allocation per frame goes over
+--max-overhead times the encoded size (plus a small fixed slack), so it can
+run as a check.
+
+Usage: python frame_alloc_bench.py [--video FILE] [--width W --height H]
+                                   [--fps F] [--frames N] [--max-overhead X]
+                                   [--json]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tracemalloc
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from is_msgs.image_pb2 import Image  # noqa: E402
+from is_wire.core import ContentType, Message  # noqa: E402
+from camera_driver.capture import VideoCapture  # noqa: E402
+from camera_driver.encoder import EncoderPool  # noqa: E402
+
+SLACK = 64 * 1024
+PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 80]
+# The first frames fill the buffer ring.
+WARMUP = 3
+
+
+def start_simulator(args):
+    # In its own process, so its allocations aren't traced.
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    command = [sys.executable, "-u", os.path.join(HERE, "camera_simulator.py"),
+               "--port", str(port), "--width", str(args.width), "--height", str(args.height),
+               "--fps", str(args.fps)]
+    if args.video:
+        command += ["--video", args.video]
+    simulator = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 universal_newlines=True)
+    simulator.stdout.readline()   # Printed once it is serving.
+    return simulator, "http://127.0.0.1:{}/Streaming/channels/101/httpPreview".format(port)
+
+
+def legacy_path(url):
+    cap = cv2.VideoCapture(url)
+
+    def frame():
+        cap.grab()
+        _, frame = cap.retrieve()
+        _, buffer = cv2.imencode(".jpeg", frame, PARAMS)
+        image = Image(data=buffer.tobytes())
+        return Message(content=image).body
+    return frame, cap.release
+
+
+def current_path(url):
+    capture = VideoCapture(url)
+    encoder = EncoderPool(1)
+
+    def frame():
+        _, frame = capture.read(timeout=5.0)
+        body = encoder.submit(frame, ".jpeg", PARAMS).result()
+        return Message(content=body, content_type=ContentType.PROTOBUF).body
+
+    def release():
+        capture.release()
+        encoder.shutdown()
+    return frame, release
+
+
+def measure(path, url, frames):
+    frame, release = path(url)
+    peaks, sizes = [], []
+    for _ in range(WARMUP + frames):
+        # Tracing restarts for every frame: it counts what the frame
+        # allocated (in any thread), not the buffers reused from before.
+        # tracemalloc.reset_peak() would do, but needs Python 3.9.
+        tracemalloc.start()
+        body = frame()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        sizes.append(len(body))
+        del body
+    release()
+    peaks, sizes = peaks[WARMUP:], sizes[WARMUP:]
+    return {
+        "frames": len(peaks),
+        "encoded_bytes": int(np.mean(sizes)),
+        "peak_bytes_mean": int(np.mean(peaks)),
+        "peak_bytes_max": int(np.max(peaks)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", help="video file to stream (default: synthetic frames)")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=float, default=30.0, help="frame rate of the stream")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--max-overhead", type=float, default=2.5,
+                        help="allowed peak allocation per frame, in encoded sizes")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    simulator, url = start_simulator(args)
+    try:
+        results = {
+            "legacy": measure(legacy_path, url, args.frames),
+            "current": measure(current_path, url, args.frames),
+        }
+    finally:
+        simulator.terminate()
+        simulator.wait()
+    current = results["current"]
+    limit = current["encoded_bytes"] * args.max_overhead + SLACK
+    results["limit_bytes"] = int(limit)
+    results["ok"] = current["peak_bytes_max"] <= limit
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<10} {:>10} {:>14} {:>16} {:>16}".format(
+            "path", "frames", "encoded (B)", "peak mean (B)", "peak max (B)"))
+        for name in ("legacy", "current"):
+            result = results[name]
+            print("{:<10} {:>10} {:>14} {:>16} {:>16}".format(
+                name, result["frames"], result["encoded_bytes"],
+                result["peak_bytes_mean"], result["peak_bytes_max"]))
+        print("limit {} bytes per frame: {}".format(results["limit_bytes"],
+                                                   "OK" if results["ok"] else "EXCEEDED"))
+    if not results["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
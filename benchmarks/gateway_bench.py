@@ -0,0 +1,398 @@
+"""Throughput and latency of the gateway frame path, per resolution and format.
+
+Runs HikvisionDriver and CameraGateway as in production, but the stream is
+read, in a loop, from a local video file (or synthetic frames) re-encoded as
+MJPEG at each resolution, ISAPI calls are answered
+in-process from benchmarks/responses and frames are "published" to an
+in-memory broker stand-in. For every case it reports the published fps, the
+per-stage latency percentiles, CPU time per frame and resident memory.
+
+With --simulator, the driver talks to camera_simulator.py over HTTP instead
+(ISAPI and an MJPEG stream at --fps, 30 by default).
+
+With --roi WxH, only a centered region of interest of that size is published
+instead of the full frame.
+
+With --baseline, the fps of each case is compared with a previous --output
+file and the script exits with an error when any case got slower than
+--tolerance allows, so it can run as a regression check.
+
+Usage: python gateway_bench.py [--video FILE] [--resolutions 1080p,960p,720p]
+                               [--formats JPEG:0.8,PNG:0.3,WebP:0.8] [--frames N] [--fps F]
+                               [--simulator] [--workers N] [--roi WxH] [--output FILE]
+                               [--baseline FILE]
+                               [--tolerance X] [--json]
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from camera_driver.capture import BufferRing, FrameStamp  # noqa: E402
+from camera_driver.hikvision import HikvisionDriver  # noqa: E402
+from camera_gateway.exporter import ZipkinBatcher  # noqa: E402
+from camera_gateway.gateway import CameraGateway  # noqa: E402
+from camera_simulator import CameraSimulator  # noqa: E402
+
+RESOLUTIONS = {"1080p": (1920, 1080), "960p": (1280, 960), "720p": (1280, 720)}
+FORMATS = "JPEG:0.5,JPEG:0.8,JPEG:0.95,PNG:0.1,PNG:0.3,PNG:0.6,WebP:0.5,WebP:0.8"
+# 'capture': waiting for and decoding a frame; 'encode_wait': in the encode
+# queue; 'encode': submitted to encoded, including any wait for an encoder
+# thread; 'publish_wait': in the publish queue; 'total': from the frame's
+# decode to its publish.
+STAGES = ("capture", "encode_wait", "encode", "publish_wait", "publish", "total")
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-= STAND-INS =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+class IsapiStandIn(BaseAdapter):
+    # Answers the driver's ISAPI calls with the documents in responses/.
+    DOCUMENTS = ("Color", "Gain", "Sharpness", "WhiteBlance", "powerLineFrequency")
+
+    def __init__(self):
+        super(IsapiStandIn, self).__init__()
+        self.documents = {}
+        for name in os.listdir(os.path.join(HERE, "responses")):
+            with open(os.path.join(HERE, "responses", name), "rb") as f:
+                self.documents[name[:-len(".xml")]] = f.read()
+
+    def _document(self, method, path):
+        if method == "PUT":
+            return "ResponseStatus"
+        if "/PTZCtrl/" in path:
+            return "PTZStatus"
+        if path.startswith("/Streaming/channels/"):
+            return "StreamingChannel"
+        for name in self.DOCUMENTS:
+            if path.endswith("/" + name):
+                return name
+        return None
+
+    def send(self, request, **kwargs):
+        path = requests.utils.urlparse(request.url).path
+        name = self._document(request.method, path)
+        reply = requests.Response()
+        reply.status_code = 200 if name else 404
+        reply._content = self.documents.get(name, b"")
+        reply.url = request.url
+        reply.request = request
+        return reply
+
+    def close(self):
+        pass
+
+
+class BrokerStandIn(object):
+    # Takes the place of both the publish channel and the RPC server.
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, message, topic=None):
+        self.messages += 1
+        self.bytes += len(message.body)
+
+    def delegate(self, **kwargs):
+        pass
+
+
+class LoopingCapture(object):
+    # Stands in for the driver's VideoCapture: a live stream that never ends.
+    # The file is decoded when the gateway asks for a frame (as VideoCapture
+    # does), at most 'fps' times a second when given, and starts over at the
+    # end.
+    def __init__(self, path, fps=0):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        self.ring = BufferRing()
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.next_frame = time.time()
+        self.frame_stamp = None
+        self.grabbed = 0
+        self.retrieved = 0
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, timeout=None):
+        if self.interval:
+            delay = self.next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_frame = max(self.next_frame, time.time() - self.interval) + self.interval
+        if not self.cap.grab():
+            self.cap.release()
+            self.cap = cv2.VideoCapture(self.path)
+            self.cap.grab()
+        buffer = self.ring.acquire()
+        ret, frame = self.cap.retrieve(image=buffer)
+        self.ring.keep(buffer, frame)
+        self.grabbed += 1
+        self.retrieved += 1
+        self.frame_stamp = FrameStamp(time.time(), self.grabbed / 30.0)
+        return ret, frame
+
+    def release(self):
+        self.cap.release()
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-= INPUT -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+def synthetic_frames(width, height, count):
+    # Smooth background with some texture and a moving object, closer to a
+    # camera image than noise (which no format can compress).
+    random = np.random.RandomState(0)
+    background = cv2.resize(random.randint(0, 255, (height // 40, width // 40, 3), np.uint8),
+                            (width, height), interpolation=cv2.INTER_CUBIC)
+    background = cv2.add(background, random.randint(0, 12, (height, width, 3), np.uint8))
+    size = height // 6
+    for i in range(count):
+        frame = background.copy()
+        x = (i * 16) % (width - size)
+        cv2.rectangle(frame, (x, height // 3), (x + size, height // 3 + size), (40, 200, 40), -1)
+        yield frame
+
+
+def video_frames(path, width, height, count):
+    cap = cv2.VideoCapture(path)
+    produced = 0
+    while produced < count:
+        ok, frame = cap.read()
+        if not ok:
+            if produced == 0:
+                raise IOError("Couldn't read {}".format(path))
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            continue
+        produced += 1
+        yield cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    cap.release()
+
+
+def write_video(frames, width, height):
+    path = os.path.join(tempfile.mkdtemp(), "bench_{}x{}.avi".format(width, height))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- RUN =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+def camera_config(path, width, height, image_format, compression, workers):
+    return {
+        "id": "bench", "ip": "camera.bench", "rtsp_port": 554, "http_port": 80,
+        "username": "bench", "password": "bench",
+        "isapi": {"auth": "basic", "timeout": 1.0},
+        "stream": {"channel_id": 1, "stream_id": 1, "compress_standart": "MJPEG",
+                   "width": width, "height": height, "fps": 30, "url": path},
+        "image": {"format": image_format, "compression": compression,
+                  "encoder_workers": workers},
+        "ptz": {"poll_fast": 0.05, "poll_idle": 1.0},
+    }
+
+
+def roi_config(roi, width, height):
+    # A centered region of 'roi' (WxH) published instead of the full frame.
+    if not roi:
+        return None
+    roi_width, roi_height = map(int, roi.split("x"))
+    return {"full_frame": False,
+            "regions": {"bench": {"x": (width - roi_width) // 2, "y": (height - roi_height) // 2,
+                                  "width": roi_width, "height": roi_height}}}
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def percentiles(values):
+    values = np.array(values) * 1000.0
+    return {
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def run_case(path, width, height, image_format, compression, args):
+    simulator = None
+    if args.simulator:
+        simulator = CameraSimulator(video=path, width=width, height=height, fps=args.fps or 30.0)
+        config = simulator.camera_config()
+        config["image"] = {"format": image_format, "compression": compression,
+                           "encoder_workers": args.workers}
+        driver = HikvisionDriver(config, zipkin_url="http://localhost:9411")
+    else:
+        session = requests.Session()
+        session.mount("http://", IsapiStandIn())
+        driver = HikvisionDriver(camera_config(path, width, height, image_format, compression,
+                                               args.workers),
+                                 zipkin_url="http://localhost:9411", session=session)
+        driver.stream.connect = lambda: LoopingCapture(path, args.fps)
+        driver.stream.open()
+    gateway = CameraGateway(driver, pipeline={"queue_size": 2, "drop_policy": "BLOCK"},
+                            tracing_config={"sampler": "never"},
+                            roi=roi_config(args.roi, width, height))
+    broker = BrokerStandIn()
+
+    samples = []
+    done = threading.Event()
+    send = gateway._send
+
+    def timed_send(content, topic, metadata=None, content_type=None, stamps=None):
+        start = time.time()
+        send(content, topic, metadata, content_type, stamps)
+        published = time.time()
+        samples.append({
+            "capture": stamps["read"] - stamps["capture_start"],
+            "encode_wait": stamps["encode_start"] - stamps["read"],
+            "encode": stamps["encoded"] - stamps["encode_start"],
+            "publish_wait": start - stamps["encoded"],
+            "publish": published - start,
+            "total": published - stamps["captured"],
+            "time": published,
+            "size": len(content),
+        })
+        if len(samples) >= args.warmup + args.frames:
+            done.set()
+
+    gateway._send = timed_send
+    batcher = ZipkinBatcher()
+    gateway.attach(broker, broker, batcher)
+    # The CPU and memory window starts after the warm-up frames.
+    while len(samples) < args.warmup and not done.wait(0.01):
+        pass
+    cpu_start, rss_start = time.process_time(), rss_bytes()
+    done.wait(args.timeout)
+    cpu = time.process_time() - cpu_start
+    rss_end = rss_bytes()
+
+    gateway.pipeline.stop()
+    driver.ptz.stop()
+    driver.ptz_tracker.stop()
+    driver.stream.stop()
+    batcher.stop()
+    if simulator is not None:
+        simulator.stop()
+
+    measured = samples[args.warmup:args.warmup + args.frames]
+    if len(measured) < 2:
+        raise RuntimeError("Only {} frames published in {}s".format(len(measured), args.timeout))
+    elapsed = measured[-1]["time"] - measured[0]["time"]
+    return {
+        "resolution": "{}x{}".format(width, height),
+        "format": image_format,
+        "compression": compression,
+        "camera_fps": args.fps,
+        "simulator": args.simulator,
+        "workers": args.workers,
+        "roi": args.roi,
+        "frames": len(measured),
+        "fps": round((len(measured) - 1) / elapsed, 2),
+        "bytes_per_frame": int(np.mean([sample["size"] for sample in measured])),
+        "cpu_ms_per_frame": round(cpu / len(measured) * 1000.0, 3),
+        "rss_mb": round(rss_end / 2.0 ** 20, 1),
+        "rss_growth_kb_per_frame": round((rss_end - rss_start) / 1024.0 / len(measured), 2),
+        "stages": {stage: percentiles([sample[stage] for sample in measured]) for stage in STAGES},
+        "pipeline": gateway.pipeline.stats(),
+    }
+
+
+def case_key(result):
+    return "{} {} {} camera_fps={} workers={} simulator={} roi={}".format(
+        result["resolution"], result["format"], result["compression"],
+        result["camera_fps"], result["workers"], result.get("simulator", False),
+        result.get("roi"))
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {case_key(result): result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(case_key(result))
+        if before is not None and result["fps"] < before["fps"] * (1.0 - tolerance):
+            regressions.append({"case": case_key(result), "baseline_fps": before["fps"],
+                                "fps": result["fps"]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", help="video file to read (default: synthetic frames)")
+    parser.add_argument("--resolutions", default="1080p,960p,720p",
+                        help="names ({}) or WxH".format(", ".join(RESOLUTIONS)))
+    parser.add_argument("--formats", default=FORMATS, help="FORMAT:compression list")
+    parser.add_argument("--frames", type=int, default=150, help="frames measured per case")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--fps", type=float, default=0,
+                        help="camera frame rate (default: as fast as the gateway takes frames)")
+    parser.add_argument("--simulator", action="store_true",
+                        help="go through camera_simulator.py (HTTP ISAPI and MJPEG stream)")
+    parser.add_argument("--workers", type=int, default=1, help="encoder threads")
+    parser.add_argument("--roi", help="publish only a centered WxH region instead of the frame")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds per case")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON from a previous --output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed fps drop against the baseline")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    cases = [(image_format, float(compression)) for image_format, compression in
+             (item.split(":") for item in args.formats.split(","))]
+    results = []
+    for name in args.resolutions.split(","):
+        width, height = RESOLUTIONS.get(name) or map(int, name.split("x"))
+        count = min(args.warmup + args.frames, 300)
+        if args.video:
+            frames = video_frames(args.video, width, height, count)
+        else:
+            frames = synthetic_frames(width, height, count)
+        path = write_video(frames, width, height)
+        for image_format, compression in cases:
+            results.append(run_case(path, width, height, image_format, compression, args))
+            if not args.json:
+                result = results[-1]
+                print("{:<10} {:<5} {:>5} {:>8.1f} fps {:>9} B {:>8.2f} ms cpu "
+                      "{:>8.2f} ms p50 {:>8.2f} ms p99".format(
+                          result["resolution"], result["format"], result["compression"],
+                          result["fps"], result["bytes_per_frame"], result["cpu_ms_per_frame"],
+                          result["stages"]["total"]["p50_ms"], result["stages"]["total"]["p99_ms"]))
+
+    report = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "opencv": cv2.__version__,
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.baseline:
+        report["regressions"] = compare(results, args.baseline, args.tolerance)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif args.baseline:
+        for regression in report["regressions"]:
+            print("REGRESSION {case}: {fps} fps (baseline {baseline_fps})".format(**regression))
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
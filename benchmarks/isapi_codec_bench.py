@@ -0,0 +1,113 @@
+"""Micro-benchmark of the ISAPI codec against the previous xmltodict path.
+
+Usage: python isapi_codec_bench.py [--number N] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import xmltodict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from camera_driver import isapi_codec  # noqa: E402
+
+# Nested keys the driver used to read from each document.
+LEGACY_PATHS = {
+    "StreamingChannel": [("StreamingChannel", "id"),
+                         ("StreamingChannel", "Video", "videoCodecType"),
+                         ("StreamingChannel", "Video", "videoResolutionWidth"),
+                         ("StreamingChannel", "Video", "videoResolutionHeight"),
+                         ("StreamingChannel", "Video", "maxFrameRate")],
+    "PTZStatus": [("PTZStatus", "AbsoluteHigh", "azimuth"),
+                  ("PTZStatus", "AbsoluteHigh", "elevation"),
+                  ("PTZStatus", "AbsoluteHigh", "absoluteZoom")],
+    "Color": [("Color", "brightnessLevel"), ("Color", "saturationLevel")],
+    "Gain": [("Gain", "GainLevel")],
+    "Sharpness": [("Sharpness", "SharpnessLevel")],
+    "WhiteBlance": [("WhiteBlance", "WhiteBlanceBlue"), ("WhiteBlance", "WhiteBlanceRed")],
+    "powerLineFrequency": [("powerLineFrequency", "powerLineFrequencyMode")],
+    "ResponseStatus": [("ResponseStatus", "statusString")],
+}
+
+
+def legacy_parse(document, paths):
+    status_json = json.loads(json.dumps(xmltodict.parse(document)))
+    values = []
+    for path in paths:
+        node = status_json
+        for key in path:
+            node = node[key]
+        values.append(node)
+    return values
+
+
+def codec_parse(document, paths):
+    fields = isapi_codec.parse(document)
+    return [fields[path[-1]] for path in paths]
+
+
+def legacy_body(codec, width, height, fps):
+    xml = "<Video>\r\n<enabled>true</enabled>\r\n<videoInputChannelID>1</videoInputChannelID>\r\n"
+    xml += "<videoCodecType>{}</videoCodecType>\r\n".format(codec)
+    xml += "<videoScanType>progressive</videoScanType>\r\n"
+    xml += "<videoResolutionWidth>{}</videoResolutionWidth>\r\n".format(width)
+    xml += "<videoResolutionHeight>{}</videoResolutionHeight>\r\n".format(height)
+    xml += "<videoQualityControlType>VBR</videoQualityControlType>\r\n<constantBitRate>4096</constantBitRate>\r\n"
+    xml += "<fixedQuality>60</fixedQuality>\r\n"
+    xml += "<maxFrameRate>{}</maxFrameRate>\r\n".format(int(fps * 100))
+    xml += "<keyFrameInterval>50</keyFrameInterval>\r\n<BPFrameInterval>0</BPFrameInterval>\r\n"
+    xml += "<snapShotImageType>JPEG</snapShotImageType>\r\n<SVC>\r\n<enabled>false</enabled>\r\n</SVC>\r\n</Video>\r\n"
+    return xml.encode()  # requests encodes str bodies before sending
+
+
+def codec_body(codec, width, height, fps):
+    return isapi_codec.render(isapi_codec.STREAMING_CHANNEL, codec=codec, width=width,
+                              height=height, max_frame_rate=int(fps * 100))
+
+
+def best_of(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for root, paths in LEGACY_PATHS.items():
+        with open(os.path.join(HERE, "responses", root + ".xml"), "rb") as f:
+            document = f.read()
+        legacy = legacy_parse(document, paths)
+        codec = codec_parse(document, paths)
+        assert [str(v) for v in legacy] == codec, (root, legacy, codec)
+        results.append({
+            "case": "parse " + root,
+            "legacy_us": best_of(lambda: legacy_parse(document, paths), args.number),
+            "codec_us": best_of(lambda: codec_parse(document, paths), args.number),
+        })
+
+    assert legacy_body("H.264", 1920, 1080, 60) == codec_body("H.264", 1920, 1080, 60)
+    results.append({
+        "case": "render StreamingChannel",
+        "legacy_us": best_of(lambda: legacy_body("H.264", 1920, 1080, 60), args.number),
+        "codec_us": best_of(lambda: codec_body("H.264", 1920, 1080, 60), args.number),
+    })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<28} {:>12} {:>12} {:>8}".format("case", "legacy (us)", "codec (us)", "speedup"))
+    for result in results:
+        print("{:<28} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            result["case"], result["legacy_us"], result["codec_us"],
+            result["legacy_us"] / result["codec_us"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Checks FramePipeline's scheduling with stages that only sleep.
+
+- overlap: capture, encode and publish each take --stage-ms; with one
+  encoder the stages must still run side by side, close to one frame per
+  stage time instead of one per three.
+- drop policies: publish is slower than capture and encode, so its queue
+  fills; DROP_OLDEST and DROP_NEWEST must drop (and count) frames, BLOCK
+  must not.
+- no wasted decodes: a 60 fps source and a 30 ms encode on one worker
+  returning futures; every frame read must be published, none cancelled.
+
+Exits with an error when a check fails.
+
+Usage: python pipeline_check.py [--stage-ms MS] [--seconds S] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from camera_gateway.pipeline import FramePipeline  # noqa: E402
+
+
+def sleeper(seconds):
+    def stage(item=None):
+        time.sleep(seconds)
+        return item if item is not None else object()
+    return stage
+
+
+def run(pipeline, seconds):
+    pipeline.start()
+    time.sleep(seconds)
+    pipeline.stop()
+    return pipeline.stats()
+
+
+def check_overlap(stage, seconds):
+    pipeline = FramePipeline(sleeper(stage), sleeper(stage), sleeper(stage), in_flight=1)
+    stats = run(pipeline, seconds)
+    fps = stats["publish"]["processed"] / seconds
+    return {"check": "overlap", "fps": round(fps, 1), "serial_fps": round(1.0 / (3 * stage), 1),
+            "ok": fps >= 0.7 / stage}
+
+
+def check_drop_policy(policy, stage, seconds):
+    pipeline = FramePipeline(sleeper(stage), sleeper(stage), sleeper(3 * stage),
+                             config={"drop_policy": policy}, in_flight=1)
+    stats = run(pipeline, seconds)
+    dropped = stats["publish"]["dropped"] + stats["encode"]["dropped"]
+    ok = dropped == 0 if policy == "BLOCK" else dropped > 0
+    return {"check": "drop_policy", "policy": policy, "dropped": dropped,
+            "published": stats["publish"]["processed"], "ok": ok}
+
+
+def check_no_wasted_decodes(seconds):
+    # Like VideoCapture.read(): waits for a frame newer than the last one.
+    cond = threading.Condition()
+    frames = {"newest": 0, "taken": 0, "read": 0}
+    running = [True]
+
+    def camera():
+        while running[0]:
+            time.sleep(1.0 / 60)
+            with cond:
+                frames["newest"] += 1
+                cond.notify_all()
+
+    def capture():
+        with cond:
+            cond.wait_for(lambda: frames["newest"] > frames["taken"], 1.0)
+            frames["taken"] = frames["newest"]
+        frames["read"] += 1
+        return object()
+
+    encoder = ThreadPoolExecutor(max_workers=1)
+    cancelled = [0]
+
+    def drop(future):
+        if future.cancel():
+            cancelled[0] += 1
+
+    threading.Thread(target=camera, daemon=True).start()
+    pipeline = FramePipeline(capture, lambda frame: encoder.submit(time.sleep, 0.03),
+                             lambda future: future.result(), in_flight=1, on_drop=drop,
+                             futures=lambda future: [future])
+    stats = run(pipeline, seconds)
+    running[0] = False
+    encoder.shutdown()
+    published = stats["publish"]["processed"]
+    # The frame being encoded when the pipeline stopped is the only one
+    # allowed to go unpublished.
+    return {"check": "no_wasted_decodes", "read": frames["read"], "published": published,
+            "cancelled": cancelled[0], "ok": cancelled[0] == 0 and frames["read"] - published <= 2}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stage-ms", type=float, default=10.0, help="time each stage sleeps")
+    parser.add_argument("--seconds", type=float, default=3.0, help="how long each check runs")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    stage = args.stage_ms / 1000.0
+    results = [check_overlap(stage, args.seconds)]
+    for policy in ("DROP_OLDEST", "DROP_NEWEST", "BLOCK"):
+        results.append(check_drop_policy(policy, stage, args.seconds))
+    results.append(check_no_wasted_decodes(args.seconds))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            details = ", ".join("{}={}".format(key, value) for key, value in result.items()
+                                if key not in ("check", "ok"))
+            print("{:<18} {:<4} {}".format(result["check"], "OK" if result["ok"] else "FAIL",
+                                           details))
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
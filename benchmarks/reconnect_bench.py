@@ -0,0 +1,153 @@
+"""Recovery from stream outages, measured against camera_simulator.py.
+
+For each outage it reports how long the driver's StreamSupervisor took to
+notice it, how long after the camera came back the first frame was published
+again, and the GetConfig latency while the stream was down (RPCs must keep
+being served). 'drop' outages close the stream, 'stall' outages keep the
+connection open without sending frames.
+
+Usage: python reconnect_bench.py [--outages N] [--duration S]
+                                 [--mode drop|stall|both] [--fps F]
+                                 [--backend opencv|pyav] [--json]
+"""
+import argparse
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from is_msgs.camera_pb2 import CameraConfigFields  # noqa: E402
+from is_msgs.common_pb2 import FieldSelector  # noqa: E402
+from camera_driver.hikvision import HikvisionDriver  # noqa: E402
+from camera_gateway.exporter import ZipkinBatcher  # noqa: E402
+from camera_gateway.gateway import CameraGateway  # noqa: E402
+from camera_simulator import CameraSimulator  # noqa: E402
+
+RECONNECT = {"min_stall": 1.0, "check_interval": 0.1, "backoff_initial": 0.25,
+             "backoff_max": 2.0, "jitter": 0.2}
+
+
+class TimedBroker(object):
+    # Broker and RPC server stand-in that keeps the publish times.
+    def __init__(self):
+        self.published = []
+
+    def publish(self, message, topic=None):
+        self.published.append(time.time())
+
+    def delegate(self, **kwargs):
+        pass
+
+    def first_after(self, start, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            index = bisect.bisect_right(self.published, start)
+            if index < len(self.published):
+                return self.published[index]
+            time.sleep(0.01)
+        return None
+
+
+def rpc_latencies(gateway, stop):
+    selector = FieldSelector(fields=[CameraConfigFields.Value("ALL")])
+    latencies, failures = [], 0
+    while not stop.is_set():
+        start = time.time()
+        try:
+            gateway.get_config(selector, None)
+            latencies.append(time.time() - start)
+        except Exception:
+            failures += 1
+        time.sleep(0.05)
+    return latencies, failures
+
+
+def run_outage(simulator, driver, gateway, broker, duration, mode, timeout):
+    stop = threading.Event()
+    rpc = {}
+    rpc_thread = threading.Thread(target=lambda: rpc.update(zip(("latencies", "failures"),
+                                                               rpc_latencies(gateway, stop))))
+    start = time.time()
+    simulator.outage(duration, mode)
+    rpc_thread.start()
+
+    detected = None
+    while time.time() - start < duration + timeout:
+        if not driver.stream.connected:
+            detected = time.time()
+            break
+        time.sleep(0.01)
+    back = start + duration
+    first = broker.first_after(back, timeout + max(0.0, back - time.time()))
+    stop.set()
+    rpc_thread.join()
+
+    latencies = np.array(rpc.get("latencies") or [0.0]) * 1000.0
+    return {
+        "mode": mode,
+        "duration": duration,
+        "detected_after": round(detected - start, 3) if detected else None,
+        "first_frame_after_recovery": round(first - back, 3) if first else None,
+        "outage_seen_by_supervisor": round(driver.stream.last_outage or 0.0, 3),
+        "rpc_calls": len(rpc.get("latencies") or []),
+        "rpc_failures": rpc.get("failures", 0),
+        "rpc_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "rpc_max_ms": round(float(latencies.max()), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outages", type=int, default=3, help="outages per mode")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds each outage lasts")
+    parser.add_argument("--mode", default="both", choices=("drop", "stall", "both"))
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--backend", default="opencv", choices=("opencv", "pyav"))
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="give up on a recovery after this many seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    simulator = CameraSimulator(width=640, height=480, fps=args.fps)
+    config = simulator.camera_config(backend=args.backend, reconnect=RECONNECT)
+    driver = HikvisionDriver(config, zipkin_url="http://localhost:9411")
+    gateway = CameraGateway(driver, tracing_config={"sampler": "never"})
+    broker = TimedBroker()
+    batcher = ZipkinBatcher()
+    gateway.attach(broker, broker, batcher)
+    time.sleep(2.0)
+
+    modes = ("drop", "stall") if args.mode == "both" else (args.mode,)
+    results = []
+    for mode in modes:
+        for _ in range(args.outages):
+            results.append(run_outage(simulator, driver, gateway, broker, args.duration, mode,
+                                      args.timeout))
+            if not args.json:
+                print("{mode:<6} detected after {detected_after}s, first frame "
+                      "{first_frame_after_recovery}s after recovery, RPC p50 {rpc_p50_ms} ms "
+                      "max {rpc_max_ms} ms ({rpc_failures} failed)".format(**results[-1]))
+            time.sleep(2.0)
+
+    gateway.pipeline.stop()
+    driver.ptz.stop()
+    driver.ptz_tracker.stop()
+    driver.stream.stop()
+    batcher.stop()
+    simulator.stop()
+    if args.json:
+        print(json.dumps({"backend": args.backend, "fps": args.fps, "reconnect": RECONNECT,
+                          "results": results}, indent=2))
+    if any(result["first_frame_after_recovery"] is None for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
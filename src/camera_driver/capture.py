@@ -0,0 +1,379 @@
+from is_wire.core import Logger
+import cv2
+import sys
+import time
+import threading
+import collections
+import requests
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# Capture backends. They all provide isOpened(), read(timeout) -> (ret, item)
+# and release(); the item is a BGR frame, or a Packet for passthrough. Frame
+# backends keep the FrameStamp of the last frame read in 'frame_stamp'.
+
+# 'time' is the wall clock time the frame was decoded (or the packet
+# received) and 'pts' its presentation time in seconds, when known.
+FrameStamp = collections.namedtuple("FrameStamp", ["time", "pts"])
+Packet = collections.namedtuple("Packet", ["data", "keyframe", "pts", "time"], defaults=(None, None))
+
+
+def pyav_available():
+    return av is not None
+
+
+class BufferRing(object):
+    # Decode targets reused from frame to frame. A buffer is handed out again
+    # only once nothing else references it (the pipeline finished with or
+    # dropped the frame); when all of them are in use a new one is decoded
+    # into, and kept if there is room.
+    def __init__(self, size=8):
+        self.size = size
+        self.buffers = []
+        self.allocated = 0
+
+    def acquire(self):
+        for buffer in self.buffers:
+            # References: the list, 'buffer' and getrefcount's argument.
+            if sys.getrefcount(buffer) <= 3:
+                return buffer
+        return None
+
+    def keep(self, old, new):
+        # retrieve() allocates a new array when none was given or the frame
+        # size changed.
+        if new is old:
+            return
+        if old is not None:
+            self.buffers.remove(old)
+        if len(self.buffers) < self.size:
+            self.buffers.append(new)
+            self.allocated += 1
+
+
+class VideoCapture:
+    # The stream is drained with grab() on every packet, but retrieve() (the
+    # conversion to a BGR ndarray) only runs while a consumer waits in read().
+    # Frames are decoded into a BufferRing, so a frame must not be modified
+    # in place by the consumer.
+    def __init__(self, name, buffers=8):
+        self.cap = cv2.VideoCapture(name)
+        self.ring = BufferRing(buffers)
+        self.run = True
+        self.frame = None
+        self.stamp = None
+        self.frame_stamp = None
+        self.waiting = 0
+        self.grabbed = 0
+        self.retrieved = 0
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._reader, daemon=True)
+        self.t.start()
+
+    def _reader(self):
+        while self.run:
+            if not self.cap.grab():
+                break
+            self.grabbed += 1
+            if not self.waiting:
+                continue
+            buffer = self.ring.acquire()
+            ret, frame = self.cap.retrieve(image=buffer)
+            if not ret:
+                break
+            self.ring.keep(buffer, frame)
+            buffer = None
+            self.retrieved += 1
+            stamp = FrameStamp(time.time(), self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+            with self.cond:
+                self.frame = frame
+                self.stamp = stamp
+                self.cond.notify_all()
+    
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, timeout=None):
+        with self.cond:
+            self.frame = None
+            self.waiting += 1
+            try:
+                ret = self.cond.wait_for(lambda: self.frame is not None, timeout)
+            finally:
+                self.waiting -= 1
+            frame, self.frame = self.frame, None
+            self.frame_stamp = self.stamp
+        return ret, frame
+
+    def release(self):
+        self.run = False
+        self.t.join()
+        self.cap.release()
+
+class PacketCapture:
+    # Passthrough capture: the camera's compressed packets are forwarded as
+    # they arrive, without decoding. Every packet is kept since H.264/H.265
+    # consumers need the whole GOP; if the consumer falls behind, the backlog
+    # is dropped and delivery restarts at the next keyframe.
+    def __init__(self, name, max_packets=120):
+        self.cap = cv2.VideoCapture(name)
+        self.cap.set(cv2.CAP_PROP_FORMAT, -1)
+        self.run = True
+        self.packets = collections.deque()
+        self.max_packets = max_packets
+        self.grabbed = 0
+        self.dropped = 0
+        self.resync = False
+        self.extradata = self._extradata()
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._reader, daemon=True)
+        self.t.start()
+
+    def _extradata(self):
+        # SPS/PPS (or VPS/SPS/PPS) of the stream, empty for MJPEG.
+        index = int(self.cap.get(cv2.CAP_PROP_CODEC_EXTRADATA_INDEX))
+        ret, extradata = self.cap.retrieve(flag=index)
+        if not ret or extradata is None:
+            return b""
+        return extradata.tobytes()
+
+    def _reader(self):
+        while self.run:
+            if not self.cap.grab():
+                break
+            ret, packet = self.cap.retrieve()
+            if not ret:
+                break
+            self.grabbed += 1
+            keyframe = bool(self.cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME))
+            pts = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            with self.cond:
+                if len(self.packets) >= self.max_packets:
+                    self.dropped += len(self.packets)
+                    self.packets.clear()
+                    self.resync = True
+                if self.resync and not keyframe:
+                    self.dropped += 1
+                    continue
+                self.resync = False
+                data = packet.tobytes()
+                if keyframe:
+                    data = self.extradata + data
+                self.packets.append(Packet(data, keyframe, pts, time.time()))
+                self.cond.notify_all()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.packets) > 0, timeout):
+                return False, None
+            return True, self.packets.popleft()
+
+    def release(self):
+        self.run = False
+        self.t.join()
+        self.cap.release()
+
+class SnapshotCapture:
+    # JPEG snapshots fetched through the camera's keep-alive ISAPI pool.
+    # 'prefetch' requests are kept in flight so the camera's snapshot latency
+    # overlaps, and 'max_fps' (0 = unbounded) keeps the camera's web server
+    # from being flooded. Only the newest snapshot is kept.
+    def __init__(self, isapi, path, prefetch=2, max_fps=0, timeout=5.0):
+        self.isapi = isapi
+        self.path = path
+        self.timeout = timeout
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.next_request = time.time()
+        self.run = True
+        self.packet = None
+        self.requested = 0
+        self.delivered = 0
+        self.grabbed = 0
+        self.errors = 0
+        self.cond = threading.Condition()
+        self.opened = self._fetch(0)
+        self.threads = [threading.Thread(target=self._fetcher, daemon=True)
+                        for _ in range(max(1, prefetch))]
+        for t in self.threads:
+            t.start()
+
+    def _fetch(self, seq):
+        try:
+            reply = self.isapi.get(self.path, timeout=self.timeout)
+        except requests.RequestException:
+            self.errors += 1
+            return False
+        if reply.status_code != 200:
+            self.errors += 1
+            return False
+        self.grabbed += 1
+        with self.cond:
+            # A slow reply must not overwrite a newer snapshot.
+            if seq >= self.delivered:
+                self.delivered = seq
+                self.packet = Packet(reply.content, True, None, time.time())
+                self.cond.notify_all()
+        return True
+
+    def _fetcher(self):
+        while self.run:
+            with self.cond:
+                wait = self.next_request - time.time()
+                self.next_request = max(self.next_request, time.time()) + self.interval
+                self.requested += 1
+                seq = self.requested
+            if wait > 0:
+                time.sleep(wait)
+            if not self._fetch(seq):
+                time.sleep(0.5)
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.packet is not None, timeout):
+                return False, None
+            packet, self.packet = self.packet, None
+        return True, packet
+
+    def release(self):
+        self.run = False
+        for t in self.threads:
+            t.join()
+
+
+class AVCapture(object):
+    logger = Logger("AVCapture")
+
+    # RTSP capture through PyAV (FFmpeg), exposing what cv2.VideoCapture
+    # hides: RTSP transport, demuxer buffering, low-delay decoding and decoder
+    # threads. Every packet is decoded (H.264/H.265 need the references), but
+    # the conversion to BGR only runs while a consumer waits in read(), as in
+    # VideoCapture. With 'passthrough' the packets are queued undecoded, as in
+    # PacketCapture. Frames and packets carry their PTS in seconds.
+    def __init__(self, url, config=None, passthrough=False, max_packets=120):
+        config = config or {}
+        self.passthrough = passthrough
+        self.max_packets = max_packets
+        self.run = True
+        self.opened = False
+        self.frame = None
+        self.stamp = None
+        self.frame_stamp = None
+        self.waiting = 0
+        self.grabbed = 0
+        self.retrieved = 0
+        self.dropped = 0
+        self.resync = False
+        self.packets = collections.deque()
+        self.cond = threading.Condition()
+
+        options = {"rtsp_transport": config.get("transport", "tcp")}
+        if config.get("low_delay", True):
+            options["fflags"] = "nobuffer"
+        if "buffer_size" in config:
+            options["buffer_size"] = str(config["buffer_size"])
+        if "max_delay" in config:
+            options["max_delay"] = str(config["max_delay"])
+        if "probesize" in config:
+            options["probesize"] = str(config["probesize"])
+        options.update(config.get("options", {}))
+        try:
+            self.container = av.open(url, container_options=options,
+                                     timeout=(config.get("open_timeout", 5.0),
+                                              config.get("read_timeout", 5.0)))
+            self.stream = self.container.streams.video[0]
+        except (av.FFmpegError, OSError, IndexError) as error:
+            self.logger.error("Couldn't open {}: {}", url, error)
+            return
+        if not passthrough:
+            # Frame threading adds one frame of delay per thread; slice
+            # threading doesn't.
+            self.stream.thread_type = config.get("thread_type", "SLICE" if config.get("low_delay", True) else "AUTO")
+            self.stream.codec_context.thread_count = config.get("threads", 0)
+            if config.get("low_delay", True):
+                self.stream.codec_context.options = {"flags": "low_delay"}
+        self.extradata = self.stream.codec_context.extradata or b""
+        self.opened = True
+        self.t = threading.Thread(target=self._reader, daemon=True)
+        self.t.start()
+
+    def _seconds(self, pts):
+        if pts is None:
+            return None
+        return float(pts * self.stream.time_base)
+
+    def _reader(self):
+        try:
+            for packet in self.container.demux(self.stream):
+                if not self.run:
+                    break
+                if packet.size == 0:
+                    continue
+                self.grabbed += 1
+                if self.passthrough:
+                    self._queue_packet(packet)
+                    continue
+                for frame in packet.decode():
+                    if not self.waiting:
+                        continue
+                    image = frame.to_ndarray(format="bgr24")
+                    self.retrieved += 1
+                    stamp = FrameStamp(time.time(), self._seconds(frame.pts))
+                    with self.cond:
+                        self.frame = image
+                        self.stamp = stamp
+                        self.cond.notify_all()
+        except av.FFmpegError as error:
+            self.logger.warn("Stream interrupted: {}", error)
+        finally:
+            self.container.close()
+
+    def _queue_packet(self, packet):
+        keyframe = packet.is_keyframe
+        with self.cond:
+            if len(self.packets) >= self.max_packets:
+                self.dropped += len(self.packets)
+                self.packets.clear()
+                self.resync = True
+            if self.resync and not keyframe:
+                self.dropped += 1
+                return
+            self.resync = False
+            data = bytes(packet)
+            if keyframe:
+                data = self.extradata + data
+            self.packets.append(Packet(data, keyframe, self._seconds(packet.pts), time.time()))
+            self.cond.notify_all()
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self, timeout=None):
+        if self.passthrough:
+            with self.cond:
+                if not self.cond.wait_for(lambda: len(self.packets) > 0, timeout):
+                    return False, None
+                return True, self.packets.popleft()
+        with self.cond:
+            self.frame = None
+            self.waiting += 1
+            try:
+                ret = self.cond.wait_for(lambda: self.frame is not None, timeout)
+            finally:
+                self.waiting -= 1
+            frame, self.frame = self.frame, None
+            self.frame_stamp = self.stamp
+        return ret, frame
+
+    def release(self):
+        self.run = False
+        if self.opened:
+            self.t.join()
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from camera_driver import metrics
+import time
+import cv2
+
+
+def image_body(data):
+    # Serialized is_msgs Image with only 'data' set (field 1, length
+    # delimited), built by hand so the encoded bytes are copied once instead
+    # of by tobytes(), Image(data=...) and SerializeToString(). No data gives
+    # an empty body, which the gateway treats as "no image".
+    size = len(data)
+    if size == 0:
+        return b""
+    header = bytearray(b"\x0a")
+    while size > 0x7f:
+        header.append(0x80 | (size & 0x7f))
+        size >>= 7
+    header.append(size)
+    return bytes(header) + data
+
+
+def _encode(frame, encode_format, encode_parameters, scale=1.0):
+    start = time.time()
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(ext=encode_format, img=frame, params=encode_parameters)
+    metrics.ENCODE_SECONDS.labels(encode_format.lstrip(".")).observe(time.time() - start)
+    if not ok:
+        return b""
+    return image_body(memoryview(buffer).cast("B"))
+
+
+class EncoderPool(object):
+    # cv2.imencode releases the GIL, so plain threads scale across cores.
+    # Frames are encoded into the body of an is_msgs Image message (see
+    # image_body), ready to be published.
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                           thread_name_prefix="encoder")
+
+    def submit(self, frame, encode_format, encode_parameters, scale=1.0):
+        # The parameters are copied so a concurrent set_image_format doesn't
+        # change a frame that is already queued.
+        return self.executor.submit(_encode, frame, encode_format, list(encode_parameters), scale)
+
+    def encode(self, frame, encode_format, encode_parameters, scale=1.0):
+        return self.submit(frame, encode_format, encode_parameters, scale).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -2,12 +2,16 @@ from is_wire.core import Logger, Status ,StatusCode, logger
 from is_msgs.image_pb2 import Image, Resolution, ImageFormat, ImageFormats
 from is_msgs.camera_pb2 import PTZControl, CameraSettings
 from is_msgs.common_pb2 import Position
+from camera_driver.encoder import EncoderPool
+from camera_driver.isapi import IsapiClient, SettingsCache
+from camera_driver import isapi_codec
+from camera_driver import metrics
+from camera_driver.ptz import PTZCommandQueue, PTZTracker
+from camera_driver.capture import VideoCapture, PacketCapture, SnapshotCapture, AVCapture, pyav_available
+from camera_driver.supervisor import StreamSupervisor
 import cv2
-import time
-import queue
-import threading
 import requests
-import xmltodict, json
+from xml.etree.ElementTree import ParseError
 from enum import Enum
 
 def assert_type(instance, _type, name):
@@ -22,43 +26,13 @@ class Parameters(Enum):
     FPS = 4
 
 
-class VideoCapture:
-    def __init__(self, name):
-        self.cap = cv2.VideoCapture(name)
-        self.run = True
-        self.q = queue.Queue()
-        self.t = threading.Thread(target=self._reader, daemon=True)
-        self.t.start()
-
-    def _reader(self):
-        while self.run:
-            self.cap.grab()
-            ret, frame = self.cap.retrieve()
-            if not ret:
-                break
-            if not self.q.empty():
-                try:
-                    self.q.get_nowait()
-                except queue.Empty:
-                    pass
-            self.q.put(frame)
-    
-    def isOpened(self):
-        return self.cap.isOpened()
-
-    def read(self):
-        return True, self.q.get()
-
-    def release(self):
-        self.run = False
-        self.t.join()
-        self.cap.release()
-
 class HikvisionDriver(object):
     logger = Logger("HikvisionDriver")
 
 # -=-=-=-=-=-=-=-=-=-=-= INITIALIZATION FUNCTIONS =-=-=-=-=-=-=-=-=-=-=-
-    def __init__(self, config, zipkin_url=None):
+    def __init__(self, config, zipkin_url=None, encoder=None, session=None):
+        # 'encoder' (an EncoderPool) and 'session' (see isapi.new_session) let
+        # several cameras in one process share encoder threads and HTTP pools.
         self.zipkin_url = zipkin_url
         self.camera_id = config['id']
         self.ip = config["ip"]
@@ -67,6 +41,9 @@ class HikvisionDriver(object):
         self.rtsp_port = config["rtsp_port"]
         self.http_port = config["http_port"]
         self.base_url = "{}:{}@{}".format(self.username, self.password, self.ip)
+        self.isapi = IsapiClient(self.ip, self.http_port, self.username, self.password,
+                                 config=config.get("isapi"), session=session)
+        self.settings = SettingsCache(self.isapi, ttl=config.get("isapi", {}).get("cache_ttl", 1.0))
 
         self.channel_id = config["stream"]["channel_id"]
         self.stream_id = config["stream"]["stream_id"]
@@ -75,65 +52,116 @@ class HikvisionDriver(object):
         self.resolution.width = config["stream"]["width"]
         self.resolution.height = config["stream"]["height"]
         self.fps = config["stream"]["fps"]
-
+        self.read_timeout = config["stream"].get("read_timeout", 1.0)
+        self.frame_buffers = config["stream"].get("frame_buffers", 8)
+        self.capture_backend = config["stream"].get("backend", "opencv")
+        self.pyav_config = config["stream"].get("pyav", {})
+        if self.capture_backend == "pyav" and not pyav_available():
+            self.logger.critical("stream.backend 'pyav' requires PyAV ('pip install av').")
+        self.frame_source = config["stream"].get("source", "rtsp")
+        # Replaces the camera's RTSP URL (e.g. a simulator or a video file).
+        self.stream_url = config["stream"].get("url")
+        self.snapshot_config = config["stream"].get("snapshot", {})
+        # Snapshots are already JPEG, so they take the passthrough path.
+        self.passthrough = config["stream"].get("passthrough", False) or self.frame_source == "snapshot"
+
+        # Set by the gateway's QualityController when the link is saturated.
+        self.quality_factor = 1.0
+        self.encode_scale = 1.0
         image_format = ImageFormat()
         image_format.format = ImageFormats.Value(config["image"]["format"])
         image_format.compression.value = config["image"]["compression"]
         self.set_image_format(image_format)
+        if encoder is None:
+            encoder = EncoderPool(config["image"].get("encoder_workers", 1))
+        self.encoder = encoder
+        self.stream = StreamSupervisor(self.camera_id, self._connect,
+                                       config=config["stream"].get("reconnect"),
+                                       frame_interval=self._frame_interval())
         status_open_stream = self._open_stream()
         if status_open_stream != Status(StatusCode.OK):
-            self.logger.critical("ERROR on camera stream initialization.")
+            # Not fatal: the StreamSupervisor keeps trying.
+            self.logger.warn("Camera stream unavailable, retrying in the background.")
         self.cam_position = Position()       
-        self.call_HomePosition()
-        while (self.cam_position.x != 0 and self.cam_position.y != 0):
-            time.sleep(1)
+        ptz_config = config.get("ptz", {})
+        self.ptz_timeout = ptz_config.get("timeout", 2.0)
+        self.ptz_tracker = PTZTracker(self._read_ptz_status,
+                                      fast_interval=ptz_config.get("poll_fast", 0.1),
+                                      idle_interval=ptz_config.get("poll_idle", 2.0))
+        self.ptz = PTZCommandQueue(self._move_absolute, self._commanded_position)
+        status_home = self.call_HomePosition()
+        if status_home.code != StatusCode.OK:
+            self.logger.warn("{}", status_home.why)
+        elif not self.ptz_tracker.wait_settled(timeout=ptz_config.get("home_timeout", 15.0)):
+            self.logger.warn("Camera didn't reach home position in time.")
         
-    def _open_stream(self):
-        if hasattr(self,'video_capture'):
-            self.__del__()
-        url = 'rtsp://{}:{}/Streaming/Channels/0{}0{}'.format(self.base_url,self.rtsp_port ,str(self.channel_id), self.stream_id)
-        retry = 1
-        max_retry = 5
-        while retry <= max_retry:
-            self.logger.info("Connecting to camera {} ({}:{})".format(self.camera_id,self.ip,self.rtsp_port))
-            self.video_capture = VideoCapture(url)
-            if self.video_capture.isOpened():
-                break
-            else:          
-                self.logger.error("Not conntected to camera {} ({}:{}). Retrying {}/{}...".format(self.camera_id,self.ip,self.rtsp_port,retry,max_retry))
-                retry += 1
+    @property
+    def video_capture(self):
+        # None while the stream is down.
+        return self.stream.capture
+
+    def _frame_interval(self):
+        if self.frame_source == "snapshot" and self.snapshot_config.get("max_fps", 0) > 0:
+            return 1.0 / self.snapshot_config["max_fps"]
+        return 1.0 / self.fps
+
+    def _connect(self):
+        # A single attempt; the StreamSupervisor retries with backoff.
+        url = self.stream_url or 'rtsp://{}:{}/Streaming/Channels/0{}0{}'.format(self.base_url,self.rtsp_port ,str(self.channel_id), self.stream_id)
+        self.logger.info("Connecting to camera {} ({}:{})".format(self.camera_id,self.ip,self.rtsp_port))
+        if self.frame_source == "snapshot":
+            capture = SnapshotCapture(
+                self.isapi,
+                '/Streaming/channels/0{}01/picture?snapShotImageType=JPEG'.format(self.channel_id),
+                prefetch=self.snapshot_config.get("prefetch", 2),
+                max_fps=self.snapshot_config.get("max_fps", 0))
+        elif self.capture_backend == "pyav":
+            capture = AVCapture(url, self.pyav_config, passthrough=self.passthrough)
+        elif self.passthrough:
+            capture = PacketCapture(url)
         else:
-            self.logger.error("Max number of connection retries have been reached.")
-            return Status(StatusCode.DEADLINE_EXCEEDED,why="Max number of connection retries have been reached.")
+            capture = VideoCapture(url, self.frame_buffers)
+        if not capture.isOpened():
+            metrics.STREAM_OPENS.labels(self.camera_id, "failed").inc()
+            self.logger.error("Not conntected to camera {} ({}:{}).".format(self.camera_id,self.ip,self.rtsp_port))
+            capture.release()
+            return None
+        metrics.STREAM_OPENS.labels(self.camera_id, "ok").inc()
         self.logger.info("Camera {} ({}:{}) connected.".format(self.camera_id,self.ip,self.rtsp_port))
+        return capture
+
+    def _open_stream(self):
+        self.stream.frame_interval = self._frame_interval()
+        if self.stream.paused:
+            # Applied when the stream is resumed.
+            self._stream_configuration()
+            return Status(StatusCode.OK)
+        if not self.stream.open():
+            return Status(StatusCode.DEADLINE_EXCEEDED,
+                          why="Couldn't connect to the camera stream, retrying in the background.")
         self._stream_configuration()
         return Status(StatusCode.OK)    
     
     def _stream_configuration(self): 
-        xml = "<Video>\r\n<enabled>true</enabled>\r\n<videoInputChannelID>1</videoInputChannelID>\r\n"
-        xml += "<videoCodecType>{}</videoCodecType>\r\n".format(self.compress_standart)
-        xml += "<videoScanType>progressive</videoScanType>\r\n"
-        xml += "<videoResolutionWidth>{}</videoResolutionWidth>\r\n".format(self.resolution.width)
-        xml += "<videoResolutionHeight>{}</videoResolutionHeight>\r\n".format(self.resolution.height)
-        xml += "<videoQualityControlType>VBR</videoQualityControlType>\r\n<constantBitRate>4096</constantBitRate>\r\n"
-        xml += "<fixedQuality>60</fixedQuality>\r\n"
-        xml += "<maxFrameRate>{}</maxFrameRate>\r\n".format(int(self.fps*100)) 
-        xml += "<keyFrameInterval>50</keyFrameInterval>\r\n<BPFrameInterval>0</BPFrameInterval>\r\n"
-        xml += "<snapShotImageType>JPEG</snapShotImageType>\r\n<SVC>\r\n<enabled>false</enabled>\r\n</SVC>\r\n</Video>\r\n"
-        url = 'http://{}:{}/Streaming/channels/0{}0{}'.format(self.base_url, self.http_port, self.channel_id, self.stream_id)
-        return requests.put(url, data=xml)
+        xml = isapi_codec.render(isapi_codec.STREAMING_CHANNEL,
+                                 codec=self.compress_standart,
+                                 width=self.resolution.width,
+                                 height=self.resolution.height,
+                                 max_frame_rate=int(self.fps*100))
+        url = '/Streaming/channels/0{}0{}'.format(self.channel_id, self.stream_id)
+        reply = self.isapi.put(url, data=xml)
+        self.settings.invalidate(url)
+        return reply
     
     def sinc_cam_status(self, param): 
-        url = 'http://{}:{}/Streaming/channels/0{}0{}'.format(self.base_url, self.http_port, self.channel_id, self.stream_id)
-        request = requests.get(url)
-        status = xmltodict.parse(request.text)
-        status_json = json.loads(json.dumps(status))
-        if param == Parameters.STREAM_ID: self.stream_id = int(str(status_json['StreamingChannel']['id'])[2]) 
-        elif param == Parameters.COMPRESS_STANDART: self.compress_standart = status_json['StreamingChannel']['Video']['videoCodecType']
+        url = '/Streaming/channels/0{}0{}'.format(self.channel_id, self.stream_id)
+        status_json = self.settings.get(url)
+        if param == Parameters.STREAM_ID: self.stream_id = int(str(status_json['id'])[2]) 
+        elif param == Parameters.COMPRESS_STANDART: self.compress_standart = status_json['videoCodecType']
         elif param == Parameters.RESOLUTION: 
-            self.resolution.width = int(status_json['StreamingChannel']['Video']['videoResolutionWidth'])
-            self.resolution.height = int(status_json['StreamingChannel']['Video']['videoResolutionHeight']) 
-        elif param == Parameters.FPS: self.fps = float(status_json['StreamingChannel']['Video']['maxFrameRate'])/100
+            self.resolution.width = int(status_json['videoResolutionWidth'])
+            self.resolution.height = int(status_json['videoResolutionHeight']) 
+        elif param == Parameters.FPS: self.fps = float(status_json['maxFrameRate'])/100
 
         else: self.logger.error('Error in camera synchronization. Consult camera drive Parameters class to know more.')
 
@@ -152,17 +180,19 @@ class HikvisionDriver(object):
         return self.compress_standart
 
     def get_image_format(self):
+        # Reports the quality frames are actually encoded with.
+        encode_parameters = self._effective_parameters()
         image_format = ImageFormat()
         if self.encode_format == ".jpeg":
             image_format.format = ImageFormats.Value("JPEG")
-            image_format.compression.value = self.encode_parameters[1] / 100.0
+            image_format.compression.value = encode_parameters[1] / 100.0
         elif self.encode_format == ".png":
             image_format.format = ImageFormats.Value("PNG")
-            image_format.compression.value = self.encode_parameters[1] / 9.0
+            image_format.compression.value = encode_parameters[1] / 9.0
         elif self.encode_format == ".webp":
             image_format.format = ImageFormats.Value("WebP")
             image_format.compression.value = (
-                self.encode_parameters[1] - 1) / 99.0
+                encode_parameters[1] - 1) / 99.0
         return image_format
 
     def get_fps(self): 
@@ -173,86 +203,112 @@ class HikvisionDriver(object):
     def get_resolution(self): 
         param = Parameters.RESOLUTION
         self.sinc_cam_status(param)
-        return self.resolution
+        if self.encode_scale >= 1.0 or self.passthrough:
+            return self.resolution
+        # Reports the size frames are actually published with while they
+        # are downscaled (as cv2.resize rounds it).
+        resolution = Resolution()
+        resolution.width = int(round(self.resolution.width * self.encode_scale))
+        resolution.height = int(round(self.resolution.height * self.encode_scale))
+        return resolution
+
+    def is_streaming(self):
+        return self.stream.connected
+
+    def pause_stream(self):
+        # Closes the camera stream while nobody wants its frames.
+        self.stream.pause()
+
+    def resume_stream(self):
+        return self.stream.resume()
+
+    def get_packet(self):
+        capture = self.stream.wait_capture(timeout=self.read_timeout)
+        if capture is None:
+            return None
+        _, packet = capture.read(timeout=self.read_timeout)
+        return packet
+
+    def is_jpeg_stream(self):
+        return self.frame_source == "snapshot" or self.compress_standart == "MJPEG"
 
     def get_np_image(self):
-        _, frame = self.video_capture.read()
+        capture = self.stream.wait_capture(timeout=self.read_timeout)
+        if capture is None:
+            return None
+        _, frame = capture.read(timeout=self.read_timeout)
         return frame    
 
+    def get_stamped_image(self):
+        # The frame and its FrameStamp (decode time and PTS).
+        capture = self.stream.wait_capture(timeout=self.read_timeout)
+        if capture is None:
+            return None, None
+        ret, frame = capture.read(timeout=self.read_timeout)
+        if not ret:
+            return None, None
+        return frame, capture.frame_stamp
+
+    def _read_ptz_status(self):
+        status_json = self.isapi.get_document('/PTZCtrl/channels/{}/status'.format(self.channel_id))
+        return (int(status_json['azimuth']), int(status_json['elevation']), int(status_json['absoluteZoom']))
+
+    def _update_position(self):
+        # Served from the PTZTracker; only the first call may wait for a poll.
+        position = self.ptz_tracker.get(timeout=self.isapi.timeout)
+        if position is not None:
+            self.cam_position.x, self.cam_position.y, self.cam_position.z = position
+
     def get_position(self): 
-        url = 'http://{}:{}/PTZCtrl/channels/{}/status'.format(self.base_url,self.http_port ,self.channel_id)
-        request = requests.get(url)
-        status = xmltodict.parse(request.text)
-        status_json = json.loads(json.dumps(status))
-        self.cam_position.x = int(status_json['PTZStatus']['AbsoluteHigh']['azimuth'])        
-        self.cam_position.y = int(status_json['PTZStatus']['AbsoluteHigh']['elevation'])
-        self.cam_position.z = int(status_json['PTZStatus']['AbsoluteHigh']['absoluteZoom'])
+        self._update_position()
         reply = PTZControl()
         reply.absolute.CopyFrom(self.cam_position)
         return reply
 
     def get_pl_frequency(self): 
         # Power line frequency: Brazil = 60Hz.
-        request_power_frequency = requests.get('http://{}:{}/Image/channels/{}/powerLineFrequency'.format(self.base_url, self.http_port ,self.channel_id))
-        status = xmltodict.parse(request_power_frequency.text)
-        status_json = json.loads(json.dumps(status))
-        pl_frequency = status_json['powerLineFrequency']['powerLineFrequencyMode']
+        status_json = self.settings.get('/Image/channels/{}/powerLineFrequency'.format(self.channel_id))
+        pl_frequency = status_json['powerLineFrequencyMode']
         return pl_frequency
 
     def get_brightness(self):
-        request_brightness = requests.get('http://{}:{}/Image/channels/{}/Color'.format(self.base_url,self.http_port,self.channel_id))
-        status = xmltodict.parse(request_brightness.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/Color'.format(self.channel_id))
         reply = CameraSettings()
-        reply.brightness.ratio = float(status_json['Color']['brightnessLevel'])/100
+        reply.brightness.ratio = float(status_json['brightnessLevel'])/100
         return reply.brightness
 
     def get_gain(self):
-        request_gain = requests.get('http://{}:{}/Image/channels/{}/Gain'.format(self.base_url, self.http_port ,self.channel_id))
-        status = xmltodict.parse(request_gain.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/Gain'.format(self.channel_id))
         reply = CameraSettings()
-        reply.gain.ratio = float(status_json['Gain']['GainLevel'])/100
+        reply.gain.ratio = float(status_json['GainLevel'])/100
         return reply.gain
 
     def get_saturation(self):
-        request_saturation = requests.get('http://{}:{}/Image/channels/{}/Color'.format(self.base_url,self.http_port,self.channel_id))
-        status = xmltodict.parse(request_saturation.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/Color'.format(self.channel_id))
         reply = CameraSettings()
-        reply.saturation.ratio = float(status_json['Color']['saturationLevel'])/100
+        reply.saturation.ratio = float(status_json['saturationLevel'])/100
         return reply.saturation
 
     def get_sharpness(self):
-        request_sharpness = requests.get('http://{}:{}/Image/channels/{}/Sharpness'.format(self.base_url,self.http_port,self.channel_id))
-        status = xmltodict.parse(request_sharpness.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/Sharpness'.format(self.channel_id))
         reply = CameraSettings()
-        reply.sharpness.ratio = float(status_json['Sharpness']['SharpnessLevel'])/100
+        reply.sharpness.ratio = float(status_json['SharpnessLevel'])/100
         return reply.sharpness
 
     def get_white_balance_bu(self):
-        request_white_balance_bu = requests.get('http://{}:{}/Image/channels/{}/WhiteBlance'.format(self.base_url,self.http_port,self.channel_id))
-        status = xmltodict.parse(request_white_balance_bu.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/WhiteBlance'.format(self.channel_id))
         reply = CameraSettings()
-        reply.white_balance_bu.ratio = float(status_json['WhiteBlance']['WhiteBlanceBlue'])/100
+        reply.white_balance_bu.ratio = float(status_json['WhiteBlanceBlue'])/100
         return reply.white_balance_bu
 
     def get_white_balance_rv(self):
-        request_white_balance_rv = requests.get('http://{}:{}/Image/channels/{}/WhiteBlance'.format(self.base_url,self.http_port,self.channel_id))
-        status = xmltodict.parse(request_white_balance_rv.text)
-        status_json = json.loads(json.dumps(status))
+        status_json = self.settings.get('/Image/channels/{}/WhiteBlance'.format(self.channel_id))
         reply = CameraSettings()
-        reply.white_balance_rv.ratio = float(status_json['WhiteBlance']['WhiteBlanceRed'])/100
+        reply.white_balance_rv.ratio = float(status_json['WhiteBlanceRed'])/100
         return reply.white_balance_rv
 
     def get_zoom(self):
-        url = 'http://{}:{}/PTZCtrl/channels/{}/status'.format(self.base_url,self.http_port ,self.channel_id)
-        request = requests.get(url)
-        status = xmltodict.parse(request.text)
-        status_json = json.loads(json.dumps(status))
-        self.cam_position.z = int(status_json['PTZStatus']['AbsoluteHigh']['absoluteZoom'])
+        self._update_position()
         zoom = float(self.cam_position.z - 10)/240 # Zoom's values are 10 to 250 (PTZControl)
         reply = CameraSettings()
         reply.zoom.ratio = zoom
@@ -284,10 +340,11 @@ class HikvisionDriver(object):
         compress_list = []
         if stream_id == 1:
             compress_list = ['H.265+','H.265','H.264+','H.264']
-            if compress_standart in compress_list: return self._open_stream()
         elif stream_id == 2 or stream_id == 3:
             compress_list = ['H.265','H.264','MJPEG']
-            if compress_standart in compress_list: return self._open_stream()
+        if compress_standart in compress_list:
+            self.compress_standart = compress_standart
+            return self._open_stream()
         else:
             return Status(StatusCode.INVALID_ARGUMENT, 
                    why="This Compress Standart is not supported by the Stream! Received: {} | Supported: {}".format(compress_standart,list(compress_list)))
@@ -408,77 +465,60 @@ class HikvisionDriver(object):
                    why="Something wrong happened when you try to set a new resolution, the stream_id wasn't recognised.")           
 
     def set_position(self, ptzcontrol):
-        elevation = int(self.cam_position.y)
-        azimuth =   int(self.cam_position.x)
-        abs_zoom =  int(self.cam_position.z)
-        
-        position = Position()
-    
-        # Step Moviment:
+        # Moves are queued and sent to the camera in the background, see
+        # PTZCommandQueue.
         if ptzcontrol.HasField("step"):
             position = ptzcontrol.step
-
-            azimuth_step =   int(position.x) * 50 # position.x 1 step value
-            elevation_step = int(position.y) * 50 # position.y 1 step value
-            zoom_step =      int(position.z) * 10 # position.z 1 step value
-
-            if (azimuth + azimuth_step) < 0: azimuth = 3600 + (azimuth + azimuth_step)
-            elif (azimuth + azimuth_step) > 3600: azimuth = (azimuth + azimuth_step) - 3600
-            else: azimuth += azimuth_step
-
-            elevation = elevation + elevation_step
-            abs_zoom = abs_zoom + zoom_step
-        
-        # Absolute Moviment:
+            queued = self.ptz.step(int(position.x) * 50, # position.x 1 step value
+                                   int(position.y) * 50, # position.y 1 step value
+                                   int(position.z) * 10) # position.z 1 step value
         elif  ptzcontrol.HasField('absolute'):
             position = ptzcontrol.absolute
-
-            elevation = int(position.y)
-            azimuth = int(position.x)
-            abs_zoom = int(position.z)
-
-            if azimuth < 0: azimuth = 3600 + azimuth
-            elif azimuth > 3600: azimuth = azimuth - 3600
-
+            queued = self.ptz.absolute(int(position.x), int(position.y), int(position.z))
         else:
             return Status(StatusCode.INVALID_ARGUMENT, 
                    why="The message request contains a different format than expected to hikvision camera gateway, consider update the driver for new options of moviment in PTZControl or try another option like absolute or step.")
 
-        # Request to camera
-        if (elevation, azimuth, abs_zoom) != (int(self.cam_position.y), int(self.cam_position.x), int(self.cam_position.z)):
-            xml = "<PTZData version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n<AbsoluteHigh>\r\n"
-            xml += "<elevation>{}</elevation>\r\n".format(str(elevation))
-            xml += "<azimuth>{}</azimuth>\r\n".format(str(azimuth))
-            xml += "<absoluteZoom>{}</absoluteZoom>\r\n".format(str(abs_zoom))
-            xml += "</AbsoluteHigh>\r\n</PTZData>"
-
-            url = 'http://{}:{}/PTZCtrl/channels/{}/absolute'.format(self.base_url,self.http_port ,self.channel_id)
-            reply = None 
-            request = requests.put(url, data=xml)
-
-            while reply != 'OK':
-                status = xmltodict.parse(request.text)
-                status_json = json.loads(json.dumps(status))
-                reply = status_json['ResponseStatus']['statusString']
-
-            if reply == 'OK':
-                return Status(StatusCode.OK)
-            else:
-                return Status(StatusCode.INTERNAL_ERROR, 
-                       why="Set_Position failed! Received: {}".format(position))
-        
+        if queued:
+            return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, 
                    why="Unsupported value! You may selected the actual position.")
 
+    def _move_absolute(self, azimuth, elevation, abs_zoom):
+        xml = isapi_codec.render(isapi_codec.PTZ_ABSOLUTE,
+                                 elevation=elevation, azimuth=azimuth, zoom=abs_zoom)
+        url = '/PTZCtrl/channels/{}/absolute'.format(self.channel_id)
+        try:
+            request = self.isapi.put(url, data=xml, timeout=self.ptz_timeout)
+        except requests.RequestException as error:
+            return Status(StatusCode.DEADLINE_EXCEEDED, why="Set_Position failed! {}".format(error))
+
+        try:
+            reply = isapi_codec.parse(request.content).get('statusString')
+        except ParseError as error:
+            # e.g. an HTML error page instead of a ResponseStatus document.
+            return Status(StatusCode.INTERNAL_ERROR,
+                   why="Set_Position failed! Unreadable reply (HTTP {}): {}".format(request.status_code, error))
+        if reply != 'OK':
+            return Status(StatusCode.INTERNAL_ERROR, 
+                   why="Set_Position failed! Received: {}".format(reply))
+        self.ptz_tracker.moving_to((azimuth, elevation, abs_zoom))
+        return Status(StatusCode.OK)
+
+    def _commanded_position(self):
+        # Base for relative moves: the target of the move in progress, or the
+        # last position read from the camera.
+        return self.ptz_tracker.expected() or \
+            (int(self.cam_position.x), int(self.cam_position.y), int(self.cam_position.z))
+
     def set_brightness(self, brightness):
         if brightness >= 0 and brightness<=1.0:
             brightness = int(brightness*100)
-            url =  'http://{}:{}/Image/channels/{}/Color'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<Color version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<brightnessLevel>{}</brightnessLevel>\r\n".format(brightness) 
-            xml += "</Color>\r\n"
-            request_brightness = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/Color'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.COLOR_BRIGHTNESS, level=brightness)
+            request_brightness = self.isapi.put(url, data=xml)
+            self.settings.invalidate(url)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported brightness value! Received: {} | Supported: 0.0 to 1.0)".format(brightness))
@@ -510,11 +550,10 @@ class HikvisionDriver(object):
     def set_saturation(self, saturation):
         if saturation >= 0 and saturation<=1.0:
             saturation = int(saturation*100)
-            url =  'http://{}:{}/Image/channels/{}/Color'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<Color version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<saturationLevel>{}</saturationLevel>\r\n".format(saturation) 
-            xml += "</Color>\r\n"
-            request_saturation = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/Color'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.COLOR_SATURATION, level=saturation)
+            request_saturation = self.isapi.put(url, data=xml)
+            self.settings.invalidate(url)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported saturation value! Received: {} | Supported: 0.0 to 1.0)".format(saturation))
@@ -522,11 +561,10 @@ class HikvisionDriver(object):
     def set_sharpness(self, sharpness):
         if sharpness >= 0 and sharpness<=1.0:
             sharpness = int(sharpness*100)
-            url =  'http://{}:{}/Image/channels/{}/Sharpness'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<Sharpness version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<SharpnessLevel>{}</SharpnessLevel>\r\n".format(sharpness) 
-            xml += "</Sharpness>\r\n"
-            request_sharpness = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/Sharpness'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.SHARPNESS, level=sharpness)
+            request_sharpness = self.isapi.put(url, data=xml)
+            self.settings.invalidate(url)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported sharpness value! Received: {} | Supported: 0.0 to 1.0)".format(sharpness))
@@ -535,11 +573,9 @@ class HikvisionDriver(object):
         '''
         if shutter >= 0 and shutter<=1.0:
             shutter = int(shutter*100)
-            url =  'http://{}:{}/Image/channels/{}/Shutter'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<Shutter version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<ShutterLevel>{}</ShutterLevel>\r\n".format(shutter) 
-            xml += "</Shutter>\r\n"
-            request_shutter = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/Shutter'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.SHUTTER, level=shutter)
+            request_shutter = self.isapi.put(url, data=xml)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported shutter value! Received: {} | Supported: 0.0 to 1.0)".format(saturation))
@@ -550,12 +586,10 @@ class HikvisionDriver(object):
     def set_white_balance_bu(self, white_balance_bu):
         if white_balance_bu >= 0 and white_balance_bu<=1.0:
             white_balance_bu = int(white_balance_bu*100)
-            url =  'http://{}:{}/Image/channels/{}/WhiteBlance'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<WhiteBlance version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<WhiteBlanceStyle>auto</WhiteBlanceStyle>\r\n"
-            xml += "<WhiteBlanceBlue>{}</WhiteBlanceBlue>\r\n".format(white_balance_bu) 
-            xml += "</WhiteBlance>\r\n"
-            request_white_balance_bu = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/WhiteBlance'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.WHITE_BALANCE_BLUE, level=white_balance_bu)
+            request_white_balance_bu = self.isapi.put(url, data=xml)
+            self.settings.invalidate(url)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported white_balance_bu value! Received: {} | Supported: 0.0 to 1.0)".format(white_balance_bu))
@@ -563,12 +597,10 @@ class HikvisionDriver(object):
     def set_white_balance_rv(self, white_balance_rv):
         if white_balance_rv >= 0 and white_balance_rv<=1.0:
             white_balance_rv = int(white_balance_rv*100)
-            url =  'http://{}:{}/Image/channels/{}/WhiteBlance'.format(self.base_url,self.http_port,self.channel_id)
-            xml =  "<WhiteBlance version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
-            xml += "<WhiteBlanceStyle>auto</WhiteBlanceStyle>\r\n"
-            xml += "<WhiteBlanceRed>{}</WhiteBlanceRed>\r\n".format(white_balance_rv) 
-            xml += "</WhiteBlance>\r\n"
-            request_white_balance_rv = requests.put(url, data=xml)
+            url =  '/Image/channels/{}/WhiteBlance'.format(self.channel_id)
+            xml = isapi_codec.render(isapi_codec.WHITE_BALANCE_RED, level=white_balance_rv)
+            request_white_balance_rv = self.isapi.put(url, data=xml)
+            self.settings.invalidate(url)
             return Status(StatusCode.OK)
         else:
             return Status(StatusCode.INVALID_ARGUMENT, why="Unsupported white_balance_rv value! Received: {} | Supported: 0.0 to 1.0)".format(white_balance_rv))
@@ -576,9 +608,11 @@ class HikvisionDriver(object):
     def set_zoom(self, zoom):
         if zoom >= 0 and zoom<=1.0:
             zoom = int(zoom*240 + 10) # 0.0 to 1.0 as 10 to 240 on PTZControl Message.
+            # Zoom from where queued moves leave the camera, not from where it is now.
+            azimuth, elevation, _ = self.ptz.target()
             ptzcontrol = PTZControl()
-            ptzcontrol.absolute.x = self.cam_position.x
-            ptzcontrol.absolute.y = self.cam_position.y
+            ptzcontrol.absolute.x = azimuth
+            ptzcontrol.absolute.y = elevation
             ptzcontrol.absolute.z = zoom
             return self.set_position(ptzcontrol)
         else:
@@ -586,20 +620,49 @@ class HikvisionDriver(object):
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-= OTHERS FUNCTIONS =-=-=-=-=-=-=-=-=-=-=-=-=-            
     def grab_image(self):
+        if self.passthrough:
+            # Only an MJPEG stream maps onto Image; H.264/H.265 packets are
+            # published by the gateway on their own topic.
+            packet = self.get_packet()
+            if packet is None or not self.is_jpeg_stream():
+                return Image()
+            return Image(data=packet.data)
         frame = self.get_np_image()
-        image = cv2.imencode(ext=self.encode_format,
-                             img=frame, params=self.encode_parameters)
-        return Image(data=image[1].tobytes())
+        if frame is None:
+            return Image()
+        return self.encode_image(frame)
+
+    def encode_image(self, frame):
+        return Image.FromString(self.encode_image_async(frame).result())
+
+    def encode_image_async(self, frame):
+        # Resolves to the serialized Image (see encoder.image_body).
+        return self.encoder.submit(frame, self.encode_format, self._effective_parameters(),
+                                   self.encode_scale)
+
+    def set_encode_adjustment(self, quality_factor, scale):
+        self.quality_factor = quality_factor
+        self.encode_scale = scale
+
+    def _effective_parameters(self):
+        # PNG is lossless, so only JPEG and WebP quality is scaled down.
+        encode_parameters = self.encode_parameters
+        if self.quality_factor < 1.0 and self.encode_format in (".jpeg", ".webp"):
+            encode_parameters = [encode_parameters[0],
+                                 max(1, int(encode_parameters[1] * self.quality_factor))]
+        return encode_parameters
 
     def __del__(self):
-        if hasattr(self,'video_capture'):
+        if hasattr(self,'stream'):
             self.logger.info("Disconnecting from video capture")
-            self.video_capture.release()
+            self.stream.stop()
 
     def call_HomePosition(self): 
-        url = 'http://{}:{}/PTZCtrl/channels/1/homeposition/goto'.format(self.base_url,self.http_port)
-        request = requests.put(url)
-        self.cam_position.x = 0
-        self.cam_position.y = 0
+        url = '/PTZCtrl/channels/1/homeposition/goto'
+        try:
+            request = self.isapi.put(url)
+        except requests.RequestException as error:
+            return Status(StatusCode.DEADLINE_EXCEEDED, why="Call_HomePosition failed! {}".format(error))
+        self.ptz_tracker.moving_to()
         self.logger.info("Calling home Position.")
         return Status(StatusCode.OK)
@@ -0,0 +1,105 @@
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth, HTTPDigestAuth
+from urllib3.util.retry import Retry
+from camera_driver import isapi_codec
+from camera_driver import metrics
+import threading
+import requests
+import time
+
+
+def new_session(pool_size=8, retries=2, hosts=1):
+    # PUTs on the camera are idempotent (they set absolute values), so they
+    # are retried as well. 'pool_size' connections are kept per camera, for
+    # up to 'hosts' cameras.
+    retry = Retry(total=retries, connect=retries, read=retries,
+                  backoff_factor=0.1, status_forcelist=(502, 503, 504),
+                  allowed_methods=("GET", "PUT"), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max(hosts, pool_size), pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class IsapiClient(object):
+    # One keep-alive connection pool per camera (or shared between cameras
+    # through 'session'), with HTTP auth and a timeout on every call.
+    def __init__(self, ip, http_port, username, password, config=None, session=None):
+        config = config or {}
+        self.base_url = "http://{}:{}".format(ip, http_port)
+        self.host = ip
+        self.timeout = config.get("timeout", 3.0)
+        if config.get("auth", "digest") == "digest":
+            self.auth = HTTPDigestAuth(username, password)
+        else:
+            self.auth = HTTPBasicAuth(username, password)
+        self.pool_size = config.get("pool_size", 8)
+        if session is None:
+            session = new_session(self.pool_size, config.get("retries", 2))
+        self.session = session
+
+    def request(self, method, path, data=None, timeout=None):
+        endpoint = path.partition("?")[0]
+        start = time.time()
+        try:
+            reply = self.session.request(method, self.base_url + path, data=data, auth=self.auth,
+                                         timeout=timeout or self.timeout)
+        except requests.RequestException:
+            metrics.ISAPI_ERRORS.labels(self.host, method, endpoint).inc()
+            raise
+        finally:
+            metrics.ISAPI_SECONDS.labels(self.host, method, endpoint).observe(time.time() - start)
+        if reply.status_code >= 400:
+            metrics.ISAPI_ERRORS.labels(self.host, method, endpoint).inc()
+        return reply
+
+    def get(self, path, timeout=None):
+        return self.request("GET", path, timeout=timeout)
+
+    def put(self, path, data=None, timeout=None):
+        return self.request("PUT", path, data=data, timeout=timeout)
+
+    def get_document(self, path, timeout=None):
+        reply = self.get(path, timeout=timeout)
+        return isapi_codec.parse(reply.content)
+
+    def close(self):
+        self.session.close()
+
+
+class SettingsCache(object):
+    # Parsed ISAPI documents kept for 'ttl' seconds. Concurrent reads of the
+    # same document share a single request, and writers invalidate the
+    # document they changed.
+    def __init__(self, isapi, ttl=1.0):
+        self.isapi = isapi
+        self.ttl = ttl
+        self.documents = {}
+        self.locks = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            path_lock = self.locks.setdefault(path, threading.Lock())
+        with path_lock:
+            entry = self.documents.get(path)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            generation = self.generation
+            document = self.isapi.get_document(path)
+            with self.lock:
+                # Don't cache a reply that raced with a write.
+                if generation == self.generation:
+                    self.documents[path] = (time.time() + self.ttl, document)
+            return document
+
+    def invalidate(self, path=None):
+        with self.lock:
+            self.generation += 1
+            if path is None:
+                self.documents.clear()
+            else:
+                self.documents.pop(path, None)
@@ -0,0 +1,104 @@
+from xml.etree.ElementTree import XMLPullParser
+import operator
+import re
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-= REQUEST BODIES =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+class Template(object):
+    # '{name}' placeholders are compiled once into a %-format, which is much
+    # cheaper to fill in than str.format with keywords.
+    def __init__(self, text):
+        names = re.findall(r"{(\w+)}", text)
+        self.pattern = re.sub(r"{\w+}", "%s", text.replace("%", "%%"))
+        if len(names) == 1:
+            self.values = lambda values: (values[names[0]],)
+        else:
+            self.values = operator.itemgetter(*names)
+
+    def render(self, **values):
+        return (self.pattern % self.values(values)).encode()
+
+
+_HEADER = " version=\"1.0\" xmlns=\"http://www.hikvision.com/ver10/XMLSchema\">\r\n"
+
+STREAMING_CHANNEL = Template(
+    "<Video>\r\n<enabled>true</enabled>\r\n<videoInputChannelID>1</videoInputChannelID>\r\n"
+    "<videoCodecType>{codec}</videoCodecType>\r\n"
+    "<videoScanType>progressive</videoScanType>\r\n"
+    "<videoResolutionWidth>{width}</videoResolutionWidth>\r\n"
+    "<videoResolutionHeight>{height}</videoResolutionHeight>\r\n"
+    "<videoQualityControlType>VBR</videoQualityControlType>\r\n<constantBitRate>4096</constantBitRate>\r\n"
+    "<fixedQuality>60</fixedQuality>\r\n"
+    "<maxFrameRate>{max_frame_rate}</maxFrameRate>\r\n"
+    "<keyFrameInterval>50</keyFrameInterval>\r\n<BPFrameInterval>0</BPFrameInterval>\r\n"
+    "<snapShotImageType>JPEG</snapShotImageType>\r\n<SVC>\r\n<enabled>false</enabled>\r\n</SVC>\r\n</Video>\r\n")
+
+PTZ_ABSOLUTE = Template(
+    "<PTZData" + _HEADER + "<AbsoluteHigh>\r\n"
+    "<elevation>{elevation}</elevation>\r\n"
+    "<azimuth>{azimuth}</azimuth>\r\n"
+    "<absoluteZoom>{zoom}</absoluteZoom>\r\n"
+    "</AbsoluteHigh>\r\n</PTZData>")
+
+COLOR_BRIGHTNESS = Template("<Color" + _HEADER + "<brightnessLevel>{level}</brightnessLevel>\r\n</Color>\r\n")
+COLOR_SATURATION = Template("<Color" + _HEADER + "<saturationLevel>{level}</saturationLevel>\r\n</Color>\r\n")
+SHARPNESS = Template("<Sharpness" + _HEADER + "<SharpnessLevel>{level}</SharpnessLevel>\r\n</Sharpness>\r\n")
+SHUTTER = Template("<Shutter" + _HEADER + "<ShutterLevel>{level}</ShutterLevel>\r\n</Shutter>\r\n")
+WHITE_BALANCE_BLUE = Template(
+    "<WhiteBlance" + _HEADER + "<WhiteBlanceStyle>auto</WhiteBlanceStyle>\r\n"
+    "<WhiteBlanceBlue>{level}</WhiteBlanceBlue>\r\n</WhiteBlance>\r\n")
+WHITE_BALANCE_RED = Template(
+    "<WhiteBlance" + _HEADER + "<WhiteBlanceStyle>auto</WhiteBlanceStyle>\r\n"
+    "<WhiteBlanceRed>{level}</WhiteBlanceRed>\r\n</WhiteBlance>\r\n")
+
+
+def render(template, **values):
+    return template.render(**values)
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-= RESPONSES =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# Fields the driver reads from each document, by root element. Parsing stops
+# as soon as all of them have been seen; documents not listed here are parsed
+# whole.
+FIELDS = {
+    "StreamingChannel": ("id", "videoCodecType", "videoResolutionWidth",
+                         "videoResolutionHeight", "maxFrameRate"),
+    "PTZStatus": ("azimuth", "elevation", "absoluteZoom"),
+    "Color": ("brightnessLevel", "saturationLevel"),
+    "Gain": ("GainLevel",),
+    "Sharpness": ("SharpnessLevel",),
+    "WhiteBlance": ("WhiteBlanceBlue", "WhiteBlanceRed"),
+    "powerLineFrequency": ("powerLineFrequencyMode",),
+    "ResponseStatus": ("statusCode", "statusString"),
+}
+
+
+def _local_name(tag):
+    return tag.rpartition("}")[2]
+
+
+def parse(document, chunk_size=4096):
+    # Returns a flat {element name: text} dict of the leaf elements the driver
+    # needs. The first occurrence of a name wins.
+    if isinstance(document, str):
+        document = document.encode()
+    parser = XMLPullParser(events=("start", "end"))
+    fields = {}
+    root = None
+    for offset in range(0, len(document), chunk_size):
+        parser.feed(document[offset:offset + chunk_size])
+        for event, element in parser.read_events():
+            name = _local_name(element.tag)
+            if event == "start":
+                if root is None:
+                    root = name
+                    wanted = set(FIELDS.get(root, ()))
+                    everything = not wanted
+                continue
+            if len(element) or name in fields:
+                continue
+            if everything or name in wanted:
+                fields[name] = (element.text or "").strip()
+                if not everything:
+                    wanted.discard(name)
+                    if not wanted:
+                        return fields
+    return fields
@@ -0,0 +1,29 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Driver side metrics, exported by the gateway's metrics endpoint.
+
+ENCODE_SECONDS = Histogram(
+    "camera_encode_seconds", "Time to resize and encode a frame", ["format"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64))
+
+ISAPI_SECONDS = Histogram(
+    "camera_isapi_seconds", "ISAPI request latency", ["host", "method", "endpoint"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+ISAPI_ERRORS = Counter(
+    "camera_isapi_errors_total", "ISAPI requests that failed or returned an HTTP error",
+    ["host", "method", "endpoint"])
+
+STREAM_OPENS = Counter(
+    "camera_stream_opens_total", "Attempts to open the camera stream, by result",
+    ["camera", "result"])
+
+STREAM_UP = Gauge(
+    "camera_stream_up", "Whether the camera stream is connected", ["camera"])
+
+STREAM_STALLS = Counter(
+    "camera_stream_lost_total", "Times the stream was lost, by reason", ["camera", "reason"])
+
+STREAM_OUTAGE_SECONDS = Histogram(
+    "camera_stream_outage_seconds", "Time from losing the stream to reconnecting", ["camera"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
@@ -0,0 +1,170 @@
+from is_wire.core import Logger, Status, StatusCode
+import threading
+import traceback
+import time
+
+
+def wrap_azimuth(azimuth):
+    # Azimuth goes from 0 to 3600 (tenths of degree).
+    if azimuth < 0: return 3600 + azimuth
+    elif azimuth > 3600: return azimuth - 3600
+    return azimuth
+
+
+class PTZCommandQueue(object):
+    logger = Logger("PTZCommandQueue")
+
+    # Moves are sent to the camera by a worker thread, so RPCs return as soon
+    # as the move is queued. Requests that arrive while a move is waiting are
+    # merged into it: a burst of steps becomes a single absolute move, and an
+    # absolute move replaces whatever was waiting.
+    def __init__(self, move, position):
+        self.move = move          # (azimuth, elevation, zoom) -> Status
+        self.position = position  # () -> (azimuth, elevation, zoom)
+        self.pending = None
+        self.in_flight = None
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.run = True
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._worker, name="ptz", daemon=True)
+        self.t.start()
+
+    def target(self):
+        # Where the camera is headed once the queued moves are done.
+        with self.cond:
+            return self._target()
+
+    def _target(self):
+        return self.pending or self.in_flight or self.position()
+
+    def absolute(self, azimuth, elevation, zoom):
+        with self.cond:
+            return self._submit((wrap_azimuth(azimuth), elevation, zoom))
+
+    def step(self, azimuth, elevation, zoom):
+        with self.cond:
+            base = self._target()
+            return self._submit((wrap_azimuth(base[0] + azimuth), base[1] + elevation, base[2] + zoom))
+
+    def _submit(self, target):
+        if target == self._target():
+            return False
+        if self.pending is not None:
+            self.merged += 1
+        self.pending = target
+        self.cond.notify_all()
+        return True
+
+    def _worker(self):
+        while self.run:
+            with self.cond:
+                if not self.cond.wait_for(lambda: self.pending is not None, timeout=0.5):
+                    continue
+                self.in_flight, self.pending = self.pending, None
+            # Whatever the move does, the queue must not stay stuck on it.
+            try:
+                status = self.move(*self.in_flight)
+            except Exception:
+                status = Status(StatusCode.INTERNAL_ERROR, why=traceback.format_exc())
+            finally:
+                with self.cond:
+                    self.in_flight = None
+                    self.cond.notify_all()
+            if status.code == StatusCode.OK:
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.logger.warn("PTZ move failed: {}", status.why)
+
+    def stop(self):
+        self.run = False
+        self.t.join()
+
+
+class PTZTracker(object):
+    logger = Logger("PTZTracker")
+
+    # Keeps the camera's PTZ position up to date in the background, polling
+    # every 'fast_interval' while the camera moves and every 'idle_interval'
+    # otherwise. A move counts as settled once the camera reaches its target,
+    # or its position stops changing for 'settle_polls' polls after a grace
+    # period (the camera may take a moment to start moving).
+    def __init__(self, read, fast_interval=0.1, idle_interval=2.0, settle_polls=3, grace=0.5):
+        self.read = read          # () -> (azimuth, elevation, zoom)
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.settle_polls = settle_polls
+        self.grace = grace
+        self.position = None
+        self.target = None
+        self.moving = False
+        self.moved_at = 0.0
+        self.stable_polls = 0
+        self.polls = 0
+        self.errors = 0
+        self.run = True
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._poller, name="ptz-tracker", daemon=True)
+        self.t.start()
+
+    def moving_to(self, target=None):
+        # Called when a move is sent to the camera; 'target' is None when the
+        # destination isn't known (e.g. home position).
+        with self.cond:
+            self.target = target
+            self.moving = True
+            self.moved_at = time.time()
+            self.stable_polls = 0
+            self.cond.notify_all()
+
+    def expected(self):
+        # Where the camera is headed, or where it is when idle.
+        with self.cond:
+            return self.target or self.position
+
+    def get(self, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.position is not None, timeout)
+            return self.position
+
+    def wait_settled(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.moving and self.position is not None, timeout)
+
+    def _update(self, position):
+        if position == self.position:
+            self.stable_polls += 1
+        else:
+            self.stable_polls = 0
+        self.position = position
+        if self.moving:
+            reached = self.target is not None and position == self.target
+            stopped = self.stable_polls >= self.settle_polls and \
+                time.time() - self.moved_at >= self.grace
+            if reached or stopped:
+                self.moving = False
+                self.target = None
+        self.cond.notify_all()
+
+    def _poller(self):
+        while self.run:
+            try:
+                position = self.read()
+            except Exception as error:
+                self.errors += 1
+                self.logger.warn("PTZ status poll failed: {}", error)
+                position = None
+            with self.cond:
+                self.polls += 1
+                if position is not None:
+                    self._update(position)
+                interval = self.fast_interval if self.moving else self.idle_interval
+                self.cond.wait(timeout=interval)
+
+    def stop(self):
+        self.run = False
+        with self.cond:
+            self.cond.notify_all()
+        self.t.join()
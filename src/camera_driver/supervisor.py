@@ -0,0 +1,167 @@
+from is_wire.core import Logger
+from camera_driver import metrics
+import threading
+import random
+import time
+
+
+class StreamSupervisor(object):
+    logger = Logger("StreamSupervisor")
+
+    # Owns the camera stream. 'connect' opens a capture (None on failure),
+    # and a watchdog reopens it in the background when its reader stops or
+    # no frame arrives for 'stall_frames' frame intervals (at least
+    # 'min_stall' seconds). Reconnects back off exponentially from
+    # 'backoff_initial' up to 'backoff_max' seconds, spread by 'jitter' (a
+    # fraction of the delay) so cameras that dropped together don't retry in
+    # step. Readers get no capture, instead of blocking, while it is down.
+    def __init__(self, name, connect, config=None, frame_interval=1.0 / 30):
+        config = config or {}
+        self.name = str(name)
+        self.connect = connect    # () -> capture or None
+        self.frame_interval = frame_interval
+        self.stall_frames = config.get("stall_frames", 30)
+        self.min_stall = config.get("min_stall", 2.0)
+        self.backoff_initial = config.get("backoff_initial", 0.5)
+        self.backoff_max = config.get("backoff_max", 30.0)
+        self.jitter = config.get("jitter", 0.2)
+        self.check_interval = config.get("check_interval", 0.5)
+        self.capture = None
+        self.connected = False
+        self.down_since = None
+        self.attempts = 0
+        self.last_grabbed = 0
+        self.last_progress = 0.0
+        self.outages = 0
+        self.last_outage = None
+        self.paused = False
+        self.run = True
+        self.connect_lock = threading.Lock()
+        self.cond = threading.Condition()
+        metrics.STREAM_UP.labels(self.name).set(0)
+        self.t = threading.Thread(target=self._watchdog, name="stream-watchdog", daemon=True)
+        self.t.start()
+
+    def open(self):
+        # (Re)opens the stream now, e.g. after its settings changed. On
+        # failure the watchdog keeps trying.
+        with self.connect_lock:
+            self._release(self._down(None))
+            capture = self.connect()
+            if capture is None:
+                with self.cond:
+                    self.attempts = 1
+                    if self.down_since is None:
+                        self.down_since = time.time()
+                return False
+            self._install(capture)
+            return True
+
+    def pause(self):
+        # Closes the stream until resume(), without counting an outage.
+        with self.connect_lock:
+            self.paused = True
+            self._release(self._down(None))
+            with self.cond:
+                self.down_since = None
+
+    def resume(self):
+        self.paused = False
+        return self.open()
+
+    def wait_capture(self, timeout=None):
+        # The current capture, or None if the stream is still down after
+        # 'timeout'.
+        with self.cond:
+            self.cond.wait_for(lambda: self.connected or not self.run, timeout)
+            return self.capture
+
+    def _install(self, capture):
+        now = time.time()
+        with self.cond:
+            self.capture = capture
+            self.connected = True
+            self.last_grabbed = capture.grabbed
+            self.last_progress = now
+            self.attempts = 0
+            outage, self.down_since = self.down_since, None
+            self.cond.notify_all()
+        metrics.STREAM_UP.labels(self.name).set(1)
+        if outage is not None:
+            self.last_outage = now - outage
+            metrics.STREAM_OUTAGE_SECONDS.labels(self.name).observe(self.last_outage)
+            self.logger.info("Stream of camera {} back after {:.1f}s.", self.name, self.last_outage)
+
+    def _down(self, reason):
+        # Marks the stream down and returns the capture to release. 'reason'
+        # is None when the stream is closed on purpose.
+        with self.cond:
+            capture, self.capture = self.capture, None
+            was_connected, self.connected = self.connected, False
+            if reason is not None and was_connected:
+                self.down_since = time.time()
+                self.outages += 1
+        metrics.STREAM_UP.labels(self.name).set(0)
+        if reason is not None and was_connected:
+            metrics.STREAM_STALLS.labels(self.name, reason).inc()
+            self.logger.warn("Stream of camera {} lost ({}), reconnecting.", self.name, reason)
+        return capture
+
+    def _release(self, capture):
+        # A stalled reader may take its full socket timeout to stop, so the
+        # capture is released in the background.
+        if capture is not None:
+            threading.Thread(target=capture.release, name="stream-release", daemon=True).start()
+
+    def _check(self):
+        capture = self.capture
+        if capture is None:
+            return
+        now = time.time()
+        grabbed = capture.grabbed
+        if grabbed != self.last_grabbed:
+            self.last_grabbed = grabbed
+            self.last_progress = now
+            return
+        reader = getattr(capture, "t", None)
+        if reader is not None and not reader.is_alive():
+            reason = "reader_stopped"
+        elif now - self.last_progress > max(self.min_stall, self.stall_frames * self.frame_interval):
+            reason = "stalled"
+        else:
+            return
+        self._release(self._down(reason))
+
+    def _backoff(self):
+        delay = min(self.backoff_max, self.backoff_initial * 2 ** max(0, self.attempts - 1))
+        return delay * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def _reconnect(self):
+        with self.connect_lock:
+            if self.connected or self.paused:
+                return
+            self.attempts += 1
+            capture = self.connect()
+            if capture is not None:
+                self._install(capture)
+
+    def _watchdog(self):
+        while self.run:
+            if self.connected:
+                self._check()
+                wait = self.check_interval
+            else:
+                wait = self._backoff()
+            with self.cond:
+                self.cond.wait(wait)
+            if self.run and not self.connected and not self.paused:
+                self._reconnect()
+
+    def stop(self):
+        self.run = False
+        with self.cond:
+            self.cond.notify_all()
+        self.t.join()
+        capture = self._down(None)
+        if capture is not None:
+            capture.release()
@@ -0,0 +1,76 @@
+from is_wire.core import Logger
+import numpy as np
+import time
+
+
+class ChangeDetector(object):
+    logger = Logger("ChangeDetector")
+
+    # Decides which frames are worth encoding. Each frame is sampled down to
+    # about 'width' pixels across (a strided view, so only the samples are
+    # read) and compared with the last published frame: a sample changed when
+    # any channel moved more than 'pixel_threshold' levels, and the frame is
+    # published when more than 'min_changed' of the samples changed. Other
+    # frames are skipped, except one every 'keepalive' seconds (0 = never).
+    def __init__(self, config=None):
+        config = config or {}
+        self.width = config.get("width", 64)
+        self.pixel_threshold = config.get("pixel_threshold", 25)
+        self.min_changed = config.get("min_changed", 0.005)
+        self.keepalive = config.get("keepalive", 1.0)
+        self.reference = None
+        self.last_published = 0.0
+        self.changed = 0
+        self.keepalives = 0
+        self.skipped = 0
+        self.score = 0.0
+
+    def _sample(self, frame):
+        step = max(1, frame.shape[1] // self.width)
+        return frame[::step, ::step].astype(np.int16)
+
+    def check(self, frame):
+        # (decision, sample): the decision is "changed", "keepalive" or None
+        # (skip). The reference only moves when published(sample) is called,
+        # so a frame lost before reaching the broker doesn't hide its change.
+        sample = self._sample(frame)
+        now = time.time()
+        if self.reference is None or self.reference.shape != sample.shape:
+            decision = "changed"
+            self.score = 1.0
+        else:
+            moved = np.abs(sample - self.reference) > self.pixel_threshold
+            if moved.ndim == 3:
+                moved = moved.any(axis=2)
+            self.score = moved.mean()
+            if self.score > self.min_changed:
+                decision = "changed"
+            elif self.keepalive > 0 and now - self.last_published >= self.keepalive:
+                decision = "keepalive"
+            else:
+                decision = None
+        if decision is None:
+            self.skipped += 1
+            return None, sample
+        if decision == "changed":
+            self.changed += 1
+        else:
+            self.keepalives += 1
+        return decision, sample
+
+    def published(self, sample):
+        self.reference = sample
+        self.last_published = time.time()
+
+    def skip_ratio(self):
+        total = self.changed + self.keepalives + self.skipped
+        return self.skipped / total if total else 0.0
+
+    def stats(self):
+        return {
+            "changed": self.changed,
+            "keepalive": self.keepalives,
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skip_ratio(), 3),
+            "last_score": round(float(self.score), 4),
+        }
@@ -0,0 +1,143 @@
+from is_wire.core import Logger
+from urllib.parse import quote
+import threading
+import requests
+import time
+
+
+def topic_matches(binding_key, topic):
+    # AMQP topic matching: '*' is one word, '#' is zero or more words.
+    return _match(binding_key.split("."), topic.split("."))
+
+
+def _match(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == "#":
+        return any(_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return pattern[0] in ("*", words[0]) and _match(pattern[1:], words[1:])
+
+
+class DemandMonitor(object):
+    logger = Logger("DemandMonitor")
+
+    # Tracks whether anyone wants the frames published on 'topics' (a
+    # callable, as they may change). With 'source' "lease", consumers renew
+    # a lease of 'lease' seconds through an RPC; with "management", the
+    # bindings of the 'is' exchange are read from the RabbitMQ management API
+    # every 'poll_interval' seconds. After 'idle_after' seconds without
+    # demand 'on_idle' is called, and 'on_active' as soon as demand is back.
+    def __init__(self, name, topics, config, on_active, on_idle):
+        self.name = name
+        self.topics = topics      # () -> list of topics
+        self.on_active = on_active
+        self.on_idle = on_idle
+        self.source = config.get("source", "lease")
+        self.lease = config.get("lease", 30.0)
+        self.idle_after = config.get("idle_after", 10.0)
+        self.poll_interval = config.get("poll_interval", 5.0)
+        self.management_url = config.get("management_url", "http://localhost:15672").rstrip("/")
+        self.auth = (config.get("username", "guest"), config.get("password", "guest"))
+        self.vhost = config.get("vhost", "/")
+        self.timeout = config.get("timeout", 2.0)
+        self.session = requests.Session()
+        now = time.time()
+        self.lease_until = 0.0
+        self.last_demand = now
+        self.active = True
+        self.changed_at = now
+        self.idle_seconds = 0.0
+        self.wakeups = 0
+        self.errors = 0
+        self.run = True
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._monitor, name="demand", daemon=True)
+        self.t.start()
+
+    def renew(self):
+        with self.cond:
+            self.lease_until = time.time() + self.lease
+            self.cond.notify_all()
+
+    def wait_active(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.active or not self.run, timeout) and self.run
+
+    def _subscribed(self):
+        url = "{}/api/exchanges/{}/is/bindings/source".format(self.management_url,
+                                                             quote(self.vhost, safe=""))
+        try:
+            reply = self.session.get(url, auth=self.auth, timeout=self.timeout)
+            reply.raise_for_status()
+            bindings = reply.json()
+        except (requests.RequestException, ValueError) as error:
+            # Without an answer, frames keep flowing.
+            self.errors += 1
+            self.logger.warn("Couldn't read the broker bindings: {}", error)
+            return True
+        topics = self.topics()
+        return any(topic_matches(binding["routing_key"], topic)
+                   for binding in bindings if binding.get("destination_type") == "queue"
+                   for topic in topics)
+
+    def _has_demand(self):
+        if self.source == "management":
+            return self._subscribed()
+        return time.time() < self.lease_until
+
+    def _monitor(self):
+        while self.run:
+            demand = self._has_demand()
+            now = time.time()
+            if demand:
+                self.last_demand = now
+            if demand and not self.active:
+                self.logger.info("{} has subscribers, resuming.", self.name)
+                self.on_active()
+                self._set_active(True, now)
+                self.wakeups += 1
+            elif not demand and self.active and now - self.last_demand >= self.idle_after:
+                self.logger.info("{} has no subscribers, going idle.", self.name)
+                self._set_active(False, now)
+                self.on_idle()
+            with self.cond:
+                if self.source == "lease":
+                    # A renew() while idle resumes at once instead of waiting
+                    # for the next poll.
+                    wait = self.lease_until - now if demand else self.idle_after
+                    self.cond.wait_for(lambda: not self.run or
+                                       (not self.active and time.time() < self.lease_until),
+                                       max(0.05, min(wait, self.poll_interval)))
+                else:
+                    self.cond.wait(self.poll_interval)
+
+    def _set_active(self, active, now):
+        with self.cond:
+            if not self.active:
+                self.idle_seconds += now - self.changed_at
+            self.active = active
+            self.changed_at = now
+            self.cond.notify_all()
+
+    def idle_time(self):
+        # Seconds spent idle so far, including the current idle period.
+        with self.cond:
+            if self.active:
+                return self.idle_seconds
+            return self.idle_seconds + time.time() - self.changed_at
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "idle_seconds": round(self.idle_time(), 1),
+            "wakeups": self.wakeups,
+            "errors": self.errors,
+        }
+
+    def stop(self):
+        self.run = False
+        with self.cond:
+            self.cond.notify_all()
+        self.t.join()
@@ -0,0 +1,118 @@
+from is_wire.core import Logger
+from camera_gateway import metrics
+import collections
+import threading
+import requests
+import json
+
+
+class BatchTransport(object):
+    # opencensus transport handing spans to a ZipkinBatcher; export() only
+    # appends to the batcher's buffer.
+    def __init__(self, batcher, exporter):
+        self.batcher = batcher
+        self.exporter = exporter
+
+    def export(self, span_datas):
+        self.batcher.add(self.exporter, span_datas)
+
+
+class ZipkinBatcher(object):
+    logger = Logger("ZipkinBatcher")
+
+    # Spans from any number of ZipkinExporters (one per camera) wait in a
+    # buffer of at most 'max_spans' and are posted by a single thread, in
+    # batches of up to 'batch_size' or every 'flush_interval' seconds. When
+    # the buffer is full the oldest spans are dropped, so a slow or missing
+    # Zipkin never holds up the frames.
+    def __init__(self, max_spans=2048, batch_size=256, flush_interval=1.0, timeout=2.0):
+        self.max_spans = max_spans
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.spans = collections.deque()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self.run = True
+        self.cond = threading.Condition()
+        self.t = threading.Thread(target=self._flusher, name="zipkin", daemon=True)
+        self.t.start()
+
+    def transport(self, exporter):
+        # Use as ZipkinExporter(transport=batcher.transport).
+        return BatchTransport(self, exporter)
+
+    def add(self, exporter, span_datas):
+        dropped = 0
+        with self.cond:
+            for span_data in span_datas:
+                if len(self.spans) >= self.max_spans:
+                    self.spans.popleft()
+                    dropped += 1
+                self.spans.append((exporter, span_data))
+            if len(self.spans) >= self.batch_size:
+                self.cond.notify()
+        if dropped:
+            self.dropped += dropped
+            metrics.SPANS_DROPPED.labels("buffer_full").inc(dropped)
+
+    def _take(self):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.spans) >= self.batch_size or not self.run,
+                               timeout=self.flush_interval)
+            count = min(len(self.spans), self.batch_size)
+            return [self.spans.popleft() for _ in range(count)]
+
+    def _flusher(self):
+        while self.run:
+            batch = self._take()
+            if batch:
+                self._post(batch)
+
+    def _post(self, batch):
+        # Spans are translated per exporter, since the service name comes
+        # from it, and posted together when they go to the same Zipkin.
+        by_exporter = collections.OrderedDict()
+        for exporter, span_data in batch:
+            by_exporter.setdefault(exporter, []).append(span_data)
+        by_url = collections.OrderedDict()
+        for exporter, span_datas in by_exporter.items():
+            by_url.setdefault(exporter.url, []).extend(exporter.translate_to_zipkin(span_datas))
+        for url, zipkin_spans in by_url.items():
+            self._send(url, zipkin_spans)
+
+    def _send(self, url, zipkin_spans):
+        try:
+            reply = self.session.post(url, data=json.dumps(zipkin_spans),
+                                      headers={"Content-Type": "application/json"},
+                                      timeout=self.timeout)
+            ok = reply.status_code < 300
+            why = "HTTP {}".format(reply.status_code)
+        except requests.RequestException as error:
+            ok = False
+            why = error
+        if ok:
+            self.exported += len(zipkin_spans)
+            metrics.SPANS_EXPORTED.inc(len(zipkin_spans))
+        else:
+            self.failed += len(zipkin_spans)
+            metrics.SPANS_DROPPED.labels("export_failed").inc(len(zipkin_spans))
+            self.logger.warn("Couldn't send {} spans to {}: {}", len(zipkin_spans), url, why)
+
+    def stats(self):
+        return {
+            "buffered": len(self.spans),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def stop(self):
+        self.run = False
+        with self.cond:
+            self.cond.notify()
+        self.t.join()
+        while self.spans:
+            self._post(self._take())
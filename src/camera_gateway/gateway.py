@@ -1,12 +1,22 @@
-from is_wire.core import Channel, Message, Logger,Status,StatusCode, Tracer, AsyncTransport
+from is_wire.core import Message, Logger,Status,StatusCode, Tracer, ContentType
 from opencensus.ext.zipkin.trace_exporter import ZipkinExporter
-from is_wire.rpc import ServiceProvider, LogInterceptor
+from opencensus.trace import attributes, time_event
 from is_msgs.camera_pb2 import CameraConfig, CameraConfigFields, PTZControl
 from is_msgs.common_pb2 import FieldSelector
 from google.protobuf.empty_pb2 import Empty
-from is_msgs.image_pb2 import Image
+from camera_gateway.pipeline import FramePipeline
+from camera_gateway.quality import QualityController
+from camera_gateway.change import ChangeDetector
+from camera_gateway.demand import DemandMonitor
+from camera_gateway.roi import RegionsOfInterest, NAME, box_from_poly, poly_from_box
+from camera_gateway.host import GatewayHost
+from camera_gateway import metrics
+from camera_gateway import tracing
+from camera_driver.encoder import image_body
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-import socket
+from datetime import datetime
+import time
 
 def get_obj(callable, obj):
     value = callable()
@@ -20,53 +30,84 @@ def get_val(callable, obj, attr):
         setattr(obj, attr, value)
 
 class CameraGateway(object):
-    def __init__(self, driver):
+    def __init__(self, driver, pipeline=None, adaptive_quality=None, executor=None, tracing_config=None,
+                 change_detection=None, demand=None, roi=None):
         self.driver = driver
+        self.tracing_config = tracing_config
+        self.sampler = tracing.make_sampler(tracing_config)
+        self.pipeline_config = pipeline or {}
+        self.adaptive_quality_config = adaptive_quality or {}
+        self.change_detection_config = change_detection or {}
+        self.demand_config = demand or {}
+        self.quality = None
+        self.change = None
+        self.demand = None
+        self.roi = RegionsOfInterest(roi)
         self.logger = Logger("CameraGateway")
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.driver.isapi.pool_size,
+                                          thread_name_prefix="get_config")
+        self.executor = executor
     
     def get_config(self, field_selector, ctx):
         fields = field_selector.fields
         camera_config = CameraConfig()
+        # Every getter is a round-trip to the camera, so they are all issued
+        # at once and merged into the reply when done.
+        getters = []
         
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("SAMPLING_SETTINGS") in fields:
-            get_val(self.driver.get_fps,
-                    camera_config.sampling.frequency, "value")
+            getters.append((get_val, self.driver.get_fps,
+                            camera_config.sampling.frequency, "value"))
         
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("IMAGE_SETTINGS") in fields:
-            get_obj(self.driver.get_resolution, camera_config.image.resolution)
-            get_obj(self.driver.get_image_format, camera_config.image.format)
+            getters.append((get_obj, self.driver.get_resolution, camera_config.image.resolution))
+            getters.append((get_obj, self.driver.get_image_format, camera_config.image.format))
 
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("CAMERA_SETTINGS") in fields:
-            get_obj(self.driver.get_brightness, camera_config.camera.brightness)
-            get_obj(self.driver.get_gain, camera_config.camera.gain)
-            get_obj(self.driver.get_saturation, camera_config.camera.saturation)
-            get_obj(self.driver.get_sharpness, camera_config.camera.sharpness)
-            get_obj(self.driver.get_white_balance_bu, camera_config.camera.white_balance_bu)
-            get_obj(self.driver.get_white_balance_rv, camera_config.camera.white_balance_rv)
-            get_obj(self.driver.get_zoom, camera_config.camera.zoom)
+            getters.append((get_obj, self.driver.get_brightness, camera_config.camera.brightness))
+            getters.append((get_obj, self.driver.get_gain, camera_config.camera.gain))
+            getters.append((get_obj, self.driver.get_saturation, camera_config.camera.saturation))
+            getters.append((get_obj, self.driver.get_sharpness, camera_config.camera.sharpness))
+            getters.append((get_obj, self.driver.get_white_balance_bu, camera_config.camera.white_balance_bu))
+            getters.append((get_obj, self.driver.get_white_balance_rv, camera_config.camera.white_balance_rv))
+            getters.append((get_obj, self.driver.get_zoom, camera_config.camera.zoom))
         
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("STREAM_CHANNEL_ID") in fields:
-            get_val(self.driver.get_stream_id,
-                    camera_config.stream_channel_id, "value")
+            getters.append((get_val, self.driver.get_stream_id,
+                            camera_config.stream_channel_id, "value"))
 
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("CHANNEL_ID") in fields:
-            get_val(self.driver.get_channel_id,
-                    camera_config.channel_id, "value")
+            getters.append((get_val, self.driver.get_channel_id,
+                            camera_config.channel_id, "value"))
 
         if CameraConfigFields.Value("ALL") in fields or \
            CameraConfigFields.Value("PTZCONTROL_SETTINGS") in fields:
-            get_obj(self.driver.get_position, camera_config.ptzcontrol)
+            getters.append((get_obj, self.driver.get_position, camera_config.ptzcontrol))
 
+        futures = [self.executor.submit(getter[1]) for getter in getters]
+        for getter, future in zip(getters, futures):
+            getter[0](future.result, *getter[2:])
 
+        if CameraConfigFields.Value("ALL") in fields or \
+           CameraConfigFields.Value("IMAGE_SETTINGS") in fields:
+            box = self.roi.get(self._metadata(ctx, "roi"))
+            if box is not None:
+                camera_config.image.region.CopyFrom(poly_from_box(box))
 
         return camera_config
 
     def set_config(self, camera_config, ctx):                   
+        if self._metadata(ctx, "full_frame") is not None:
+            maybe_ok = self._set_full_frame(self._metadata(ctx, "full_frame"))
+            if maybe_ok.code != StatusCode.OK:
+                return maybe_ok
+
         if camera_config.HasField("sampling"):
             if camera_config.sampling.HasField("frequency"):
                 maybe_ok = self.driver.set_fps(camera_config.sampling.frequency.value)
@@ -82,6 +123,10 @@ class CameraGateway(object):
                 maybe_ok = self.driver.set_resolution(camera_config.image.resolution)
                 if maybe_ok.code != StatusCode.OK:
                     return maybe_ok
+            if camera_config.image.HasField("region"):
+                maybe_ok = self._set_region(camera_config.image.region, ctx)
+                if maybe_ok.code != StatusCode.OK:
+                    return maybe_ok
 
         if camera_config.HasField("camera"):
             if camera_config.camera.HasField("brightness"):
@@ -150,59 +195,286 @@ class CameraGateway(object):
 
         return Status(StatusCode.OK)
         
+    def _metadata(self, ctx, key):
+        # Regions are named by the 'roi' metadata of the request, and the
+        # full frame is switched on or off by its 'full_frame' metadata.
+        if ctx is None:
+            return None
+        return ctx.request.metadata.get(key)
+
+    def _set_full_frame(self, value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        full_frame = {"true": True, "1": True, "false": False, "0": False}.get(str(value).lower())
+        if full_frame is None:
+            return Status(StatusCode.INVALID_ARGUMENT,
+                why="'full_frame' metadata must be true or false. Received: {}".format(value))
+        if self.driver.passthrough:
+            return Status(StatusCode.FAILED_PRECONDITION,
+                why="Passthrough mode always publishes the full frame.")
+        self.roi.set_full_frame(full_frame)
+        return Status(StatusCode.OK)
+
+    def _set_region(self, region, ctx):
+        name = self._metadata(ctx, "roi")
+        if name is None or not NAME.match(name):
+            return Status(StatusCode.INVALID_ARGUMENT,
+                why="Name the region in the request's 'roi' metadata (letters, digits, '_' or '-'). Received: {}".format(name))
+        if self.driver.passthrough:
+            return Status(StatusCode.FAILED_PRECONDITION,
+                why="Regions of interest need decoded frames, which passthrough mode doesn't have.")
+        box = box_from_poly(region)
+        if box is None and len(region.vertices) > 0:
+            return Status(StatusCode.INVALID_ARGUMENT, why="Region '{}' has no area.".format(name))
+        # A region without vertices removes it.
+        self.roi.set(name, box)
+        return Status(StatusCode.OK)
+
+    # Each frame carries a dict of wall clock times through the pipeline:
+    # 'capture_start' (when the capture stage asked for it), 'captured'
+    # (decoded, or received for packets), 'read', 'encode_start' and
+    # 'encoded', plus the stream's 'pts' when the backend knows it. Whether
+    # the frame is traced ('sampled') is decided when it is captured.
+    def _capture(self):
+        if not self._wanted():
+            return None
+        capture_start = time.time()
+        frame, stamp = self.driver.get_stamped_image()
+        if frame is None:
+            # Outages are reported by the driver's StreamSupervisor.
+            if self.driver.is_streaming():
+                self.logger.warn("No image captured.")
+            return None
+        sample = None
+        if self.change is not None:
+            # Unchanged frames are dropped before they cost an encode.
+            decision, sample = self.change.check(frame)
+            if decision is None:
+                return None
+        return frame, {"capture_start": capture_start, "captured": stamp.time,
+                       "read": time.time(), "pts": stamp.pts,
+                       "sampled": self.sampler.sample()}, sample
+
+    def _encode(self, captured):
+        # One image per topic: the full frame (unless switched off) and a
+        # crop of each region of interest.
+        frame, stamps, sample = captured
+        images = []
+        if self.roi.full_frame:
+            images.append((self.service_name + ".Frame", frame))
+        for name, crop in self.roi.crops(frame):
+            images.append((self.service_name + ".Frame.ROI." + name, crop))
+        pending_images = []
+        for topic, image in images:
+            image_stamps = dict(stamps, encode_start=time.time())
+            future = self.driver.encode_image_async(image)
+            future.add_done_callback(lambda _, s=image_stamps: s.__setitem__("encoded", time.time()))
+            pending_images.append((topic, image_stamps, future))
+        return sample, pending_images
+
+    def _publish(self, encoded):
+        sample, pending_images = encoded
+        sent = False
+        for topic, stamps, future in pending_images:
+            body = future.result()
+            # result() may return before the done callback has run.
+            stamps.setdefault("encoded", time.time())
+            if len(body) > 0:
+                self._send(body, topic, content_type=ContentType.PROTOBUF, stamps=stamps)
+                sent = True
+                if self.quality is not None:
+                    # From the end of the encode, so a slow encoder isn't
+                    # taken for publish back-pressure.
+                    self.quality.observe(len(body), time.time() - stamps["encoded"])
+            else:
+                self.logger.warn("No image captured.")
+        if sent and self.change is not None:
+            # Subscribers have this frame now, later ones are compared to it.
+            self.change.published(sample)
+
+    def _capture_packet(self):
+        if not self._wanted():
+            return None
+        packet = self.driver.get_packet()
+        if packet is None and self.driver.is_streaming():
+            self.logger.warn("No image captured.")
+        return packet
+
+    def _publish_packet(self, packet):
+        stamps = {"captured": packet.time, "pts": packet.pts, "sampled": self.sampler.sample()}
+        if self.driver.is_jpeg_stream():
+            self._send(image_body(packet.data), self.service_name + ".Frame",
+                       content_type=ContentType.PROTOBUF, stamps=stamps)
+        else:
+            metadata = {
+                "codec": self.driver.compress_standart,
+                "keyframe": packet.keyframe,
+            }
+            self._send(packet.data, self.service_name + ".Stream", metadata, stamps=stamps)
+
+    def _wanted(self):
+        # While nobody is subscribed nothing is read, decoded or encoded.
+        return self.demand is None or self.demand.wait_active(self.driver.read_timeout)
+
+    def _idle_stream(self):
+        if self.demand_config.get("close_stream", True):
+            self.driver.pause_stream()
 
-    def run(self,broker_uri):
+    def _resume_stream(self):
+        if self.demand_config.get("close_stream", True):
+            self.driver.resume_stream()
+
+    def _topics(self):
+        if self.driver.passthrough:
+            return [self.service_name + ".Stream", self.service_name + ".Frame"]
+        topics = [self.service_name + ".Frame.ROI." + name for name in self.roi.names()]
+        if self.roi.full_frame:
+            topics.append(self.service_name + ".Frame")
+        return topics
+
+    def _subscribe(self, request, ctx):
+        self.demand.renew()
+        return Empty()
+
+    def _send(self, content, topic, metadata=None, content_type=None, stamps=None):
+        # Frames arrive already serialized, so the body is used as is.
+        msg = Message(content=content, content_type=content_type)
+        metadata = dict(metadata or {})
+        if stamps is not None:
+            if stamps.get("captured") is not None:
+                metadata["capture_time"] = stamps["captured"]
+            if stamps.get("pts") is not None:
+                metadata["pts"] = stamps["pts"]
+        if metadata:
+            msg.metadata = metadata
+
+        if stamps is not None and stamps.get("sampled"):
+            tracer = Tracer(self.exporter)
+            with tracer.span(name="frame") as span:
+                self._trace_stages(span, stamps)
+                msg.inject_tracing(span)
+                start = time.time()
+                self.publish_channel.publish(msg, topic=topic)
+                published = time.time()
+                tracing.add_child_span(span, "publish", start, published)
+        else:
+            start = time.time()
+            self.publish_channel.publish(msg, topic=topic)
+            published = time.time()
+
+        camera = str(self.driver.camera_id)
+        kind = topic[len(self.service_name) + 1:]
+        metrics.PUBLISH_SECONDS.labels(camera).observe(published - start)
+        metrics.PUBLISHED_BYTES.labels(camera, kind).inc(len(content))
+        metrics.PUBLISHED_MESSAGES.labels(camera, kind).inc()
+        if stamps is not None and stamps.get("captured") is not None:
+            metrics.FRAME_LATENCY_SECONDS.labels(camera).observe(published - stamps["captured"])
+
+    def _trace_stages(self, span, stamps):
+        # The frame span covers the frame's whole stay in the gateway, with a
+        # child span per stage.
+        begin = [stamps[key] for key in ("capture_start", "captured") if stamps.get(key) is not None]
+        if begin:
+            span.start_time = tracing.timestamp(min(begin))
+        if stamps.get("capture_start") is not None:
+            tracing.add_child_span(span, "capture-wait", stamps["capture_start"], stamps["read"])
+        if stamps.get("encode_start") is not None:
+            tracing.add_child_span(span, "encode", stamps["encode_start"], stamps["encoded"])
+        for key in ("captured", "encode_start", "encoded"):
+            if stamps.get(key) is None:
+                continue
+            annotation = {}
+            if key == "captured" and stamps.get("pts") is not None:
+                annotation["pts"] = stamps["pts"]
+            span.add_time_event(time_event.TimeEvent(
+                datetime.utcfromtimestamp(stamps[key]),
+                time_event.Annotation(key, attributes.Attributes(annotation))))
+
+    def _traced(self, function, name):
+        # RPCs are traced when the caller traces them or the sampler says so.
+        def traced(request, ctx):
+            if "x-b3-traceid" not in ctx.request.metadata and not self.sampler.sample():
+                return function(request, ctx)
+            tracer = Tracer(self.exporter, span_context=ctx.request.extract_tracing())
+            with tracer.span(name="rpc") as span:
+                span.add_attribute("rpc", name)
+                return function(request, ctx)
+        return traced
+
+    def attach(self, publish_channel, server, span_batcher):
+        # Registers this camera's RPCs on 'server' and starts publishing its
+        # frames on 'publish_channel'; both may be shared with other cameras,
+        # as may 'span_batcher', which sends the spans to Zipkin.
         service_name = "CameraGateway.{}".format(self.driver.camera_id)
+        self.service_name = service_name
 
-        publish_channel = Channel(broker_uri)
+        self.publish_channel = publish_channel
         parsed = urlparse(self.driver.zipkin_url)
         zipkin_host = parsed.hostname
         zipkin_port = parsed.port
         
-        exporter = ZipkinExporter(
+        self.exporter = ZipkinExporter(
             service_name=service_name,
             host_name=zipkin_host,
             port=zipkin_port,
-            transport=AsyncTransport,
+            transport=span_batcher.transport,
             )
 
-        rpc_channel = Channel(broker_uri)
-        server = ServiceProvider(rpc_channel)
-
-        logging = LogInterceptor()
-        server.add_interceptor(logging)
-
         server.delegate(
             topic=service_name + ".GetConfig",
             request_type=FieldSelector,
             reply_type=CameraConfig,
-            function=self.get_config)
+            function=self._traced(self.get_config, "GetConfig"))
 
         server.delegate(
             topic=service_name + ".SetConfig",
             request_type=CameraConfig,
             reply_type=Empty,
-            function=self.set_config)
+            function=self._traced(self.set_config, "SetConfig"))
 
-        self.logger.info("RPC listening for requests")
+        if self.demand_config.get("enabled", False):
+            self.demand = DemandMonitor(service_name, self._topics, self.demand_config,
+                                        on_active=self._resume_stream, on_idle=self._idle_stream)
+            if self.demand.source == "lease":
+                server.delegate(
+                    topic=service_name + ".Subscribe",
+                    request_type=Empty,
+                    reply_type=Empty,
+                    function=self._subscribe)
 
-        while True:
-            tracer = Tracer(exporter)
-            message = Message()
-            with tracer.span(name="frame") as span:
-                try:
-                    message = rpc_channel.consume(timeout=0)
-                    if server.should_serve(message):
-                        server.serve(message)
-                except socket.timeout:
-                    pass
-        
-                image = self.driver.grab_image()
-                msg = Message(content=image)
-                msg.inject_tracing(span)
-                if len(image.data) > 0:
-                    publish_channel.publish(msg, topic=service_name + ".Frame")
-                else:
-                    self.logger.warn("No image captured.")
-            
-                
+        if self.driver.passthrough:
+            self.pipeline = FramePipeline(
+                capture=self._capture_packet,
+                encode=None,
+                publish=self._publish_packet,
+                config=self.pipeline_config)
+        else:
+            if self.adaptive_quality_config.get("enabled", False):
+                self.quality = QualityController(self.driver.set_encode_adjustment,
+                                                 self.adaptive_quality_config)
+            if self.change_detection_config.get("enabled", False):
+                self.change = ChangeDetector(self.change_detection_config)
+            self.pipeline = FramePipeline(
+                capture=self._capture,
+                encode=self._encode,
+                publish=self._publish,
+                config=self.pipeline_config,
+                in_flight=self.driver.encoder.workers,
+                on_drop=lambda encoded: [future.cancel() for _, _, future in encoded[1]],
+                futures=lambda encoded: [future for _, _, future in encoded[1]])
+        self.pipeline.start()
+
+    def log_stats(self):
+        self.logger.info("{} pipeline stats: {}", self.service_name, self.pipeline.stats())
+        if self.quality is not None:
+            self.logger.info("{} quality stats: {}", self.service_name, self.quality.stats())
+        if self.change is not None:
+            self.logger.info("{} change detection stats: {}", self.service_name, self.change.stats())
+        if self.demand is not None:
+            self.logger.info("{} demand stats: {}", self.service_name, self.demand.stats())
+
+    def run(self, broker_uri, metrics_port=None):
+        host = GatewayHost(broker_uri, stats_interval=self.pipeline_config.get("stats_interval", 10.0),
+                           metrics_port=metrics_port, tracing_config=self.tracing_config)
+        host.add(self)
+        host.run()
@@ -0,0 +1,70 @@
+from is_wire.core import Channel, Logger
+from is_wire.rpc import ServiceProvider, LogInterceptor
+from camera_gateway.exporter import ZipkinBatcher
+from camera_gateway import metrics
+import threading
+import socket
+import time
+
+
+class SharedChannel(object):
+    # py-amqp channels aren't thread-safe, so pipelines publishing on the same
+    # connection take turns.
+    def __init__(self, channel):
+        self.channel = channel
+        self.lock = threading.Lock()
+
+    def publish(self, message, topic=None):
+        with self.lock:
+            self.channel.publish(message, topic=topic)
+
+    def close(self):
+        self.channel.close()
+
+
+class GatewayHost(object):
+    logger = Logger("GatewayHost")
+
+    # Hosts any number of CameraGateways in one process. The RPCs of every
+    # camera are served from one broker connection, and frames go out over
+    # 'publish_connections' connections, assigned to cameras in turn.
+    # Prometheus metrics are served on 'metrics_port', when given, and the
+    # spans of every camera go to Zipkin through one ZipkinBatcher.
+    def __init__(self, broker_uri, publish_connections=1, stats_interval=10.0, metrics_port=None,
+                 tracing_config=None):
+        self.rpc_channel = Channel(broker_uri)
+        self.server = ServiceProvider(self.rpc_channel)
+        self.server.add_interceptor(LogInterceptor())
+        self.server.add_interceptor(metrics.RPCMetricsInterceptor())
+        self.publish_channels = [SharedChannel(Channel(broker_uri))
+                                 for _ in range(max(1, publish_connections))]
+        self.stats_interval = stats_interval
+        self.gateways = []
+        self.span_batcher = ZipkinBatcher(**(tracing_config or {}).get("export", {}))
+        metrics.REGISTRY.register(metrics.GatewayCollector(self.gateways))
+        if metrics_port:
+            metrics.start_server(metrics_port)
+            self.logger.info("Metrics served on port {}", metrics_port)
+
+    def add(self, gateway):
+        channel = self.publish_channels[len(self.gateways) % len(self.publish_channels)]
+        gateway.attach(channel, self.server, self.span_batcher)
+        self.gateways.append(gateway)
+        self.logger.info("Serving {}", gateway.service_name)
+
+    def run(self):
+        self.logger.info("RPC listening for requests")
+        last_stats = time.time()
+        while True:
+            try:
+                message = self.rpc_channel.consume(timeout=1.0)
+                if self.server.should_serve(message):
+                    self.server.serve(message)
+            except socket.timeout:
+                pass
+
+            if time.time() - last_stats >= self.stats_interval:
+                last_stats = time.time()
+                for gateway in self.gateways:
+                    gateway.log_stats()
+                self.logger.info("Span export stats: {}", self.span_batcher.stats())
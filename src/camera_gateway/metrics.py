@@ -0,0 +1,120 @@
+from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from is_wire.rpc import Interceptor
+import time
+
+# Gateway side metrics. The driver's are in camera_driver.metrics; both are
+# served by start_server().
+
+PUBLISH_SECONDS = Histogram(
+    "gateway_publish_seconds", "Time to hand a message to the broker", ["camera"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+
+FRAME_LATENCY_SECONDS = Histogram(
+    "gateway_frame_latency_seconds", "Time from capture to publish", ["camera"],
+    buckets=(0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56))
+
+PUBLISHED_BYTES = Counter(
+    "gateway_published_bytes_total", "Bytes published", ["camera", "topic"])
+
+PUBLISHED_MESSAGES = Counter(
+    "gateway_published_messages_total", "Messages published", ["camera", "topic"])
+
+SPANS_EXPORTED = Counter(
+    "gateway_spans_exported_total", "Spans sent to Zipkin")
+
+SPANS_DROPPED = Counter(
+    "gateway_spans_dropped_total", "Spans dropped, by reason", ["reason"])
+
+RPC_SECONDS = Histogram(
+    "gateway_rpc_seconds", "RPC handling time", ["topic", "status_code"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+
+def start_server(port):
+    start_http_server(port)
+
+
+class RPCMetricsInterceptor(Interceptor):
+    # Like is_wire's MetricsInterceptor, but with a latency histogram.
+    def before_call(self, context):
+        self.begin = time.time()
+
+    def after_call(self, context):
+        RPC_SECONDS.labels(context.request.topic, context.reply.status.code.name) \
+            .observe(time.time() - self.begin)
+
+
+class GatewayCollector(object):
+    # Counters the pipeline and capture objects already keep, read at scrape
+    # time instead of being updated on every frame.
+    def __init__(self, gateways):
+        self.gateways = gateways
+
+    def collect(self):
+        grabbed = CounterMetricFamily(
+            "camera_frames_grabbed_total", "Frames (or packets) read from the camera",
+            labels=["camera"])
+        dropped = CounterMetricFamily(
+            "camera_frames_dropped_total", "Frames read from the camera but not delivered",
+            labels=["camera"])
+        processed = CounterMetricFamily(
+            "gateway_stage_processed_total", "Items handled by each pipeline stage",
+            labels=["camera", "stage"])
+        errors = CounterMetricFamily(
+            "gateway_stage_errors_total", "Errors raised by each pipeline stage",
+            labels=["camera", "stage"])
+        queue_dropped = CounterMetricFamily(
+            "gateway_queue_dropped_total", "Items dropped by the queue feeding each stage",
+            labels=["camera", "stage"])
+        queue_depth = GaugeMetricFamily(
+            "gateway_queue_depth", "Items waiting in the queue feeding each stage",
+            labels=["camera", "stage"])
+        change_frames = CounterMetricFamily(
+            "gateway_change_frames_total",
+            "Frames seen by change detection, by decision (changed, keepalive, skipped)",
+            labels=["camera", "decision"])
+        skip_ratio = GaugeMetricFamily(
+            "gateway_change_skip_ratio", "Fraction of frames skipped as unchanged",
+            labels=["camera"])
+        demand_active = GaugeMetricFamily(
+            "gateway_demand_active", "Whether the camera has subscribers (1) or is idle (0)",
+            labels=["camera"])
+        idle_seconds = CounterMetricFamily(
+            "gateway_demand_idle_seconds_total", "Time spent idle for lack of subscribers",
+            labels=["camera"])
+        wakeups = CounterMetricFamily(
+            "gateway_demand_wakeups_total", "Times the camera resumed after being idle",
+            labels=["camera"])
+        for gateway in list(self.gateways):
+            camera = str(gateway.driver.camera_id)
+            capture = getattr(gateway.driver, "video_capture", None)
+            if capture is not None:
+                grabbed.add_metric([camera], getattr(capture, "grabbed", 0))
+                dropped.add_metric([camera], self._capture_dropped(capture))
+            for stage, stats in gateway.pipeline.stats().items():
+                processed.add_metric([camera, stage], stats["processed"])
+                errors.add_metric([camera, stage], stats["errors"])
+                if "queue_depth" in stats:
+                    queue_dropped.add_metric([camera, stage], stats["dropped"])
+                    queue_depth.add_metric([camera, stage], stats["queue_depth"])
+            change = getattr(gateway, "change", None)
+            if change is not None:
+                change_frames.add_metric([camera, "changed"], change.changed)
+                change_frames.add_metric([camera, "keepalive"], change.keepalives)
+                change_frames.add_metric([camera, "skipped"], change.skipped)
+                skip_ratio.add_metric([camera], change.skip_ratio())
+            demand = getattr(gateway, "demand", None)
+            if demand is not None:
+                demand_active.add_metric([camera], 1 if demand.active else 0)
+                idle_seconds.add_metric([camera], demand.idle_time())
+                wakeups.add_metric([camera], demand.wakeups)
+        return [grabbed, dropped, processed, errors, queue_dropped, queue_depth,
+                change_frames, skip_ratio, demand_active, idle_seconds, wakeups]
+
+    def _capture_dropped(self, capture):
+        # Decoding backends drop what nobody was waiting for; packet
+        # backends count their drops.
+        if hasattr(capture, "retrieved") and not getattr(capture, "passthrough", False):
+            return capture.grabbed - capture.retrieved
+        return getattr(capture, "dropped", 0)
@@ -0,0 +1,198 @@
+from is_wire.core import Logger
+from enum import Enum
+import threading
+import traceback
+import queue
+
+
+class DropPolicy(Enum):
+    DROP_OLDEST = 1 # Discard the queued item to make room for the new one.
+    DROP_NEWEST = 2 # Discard the incoming item, keep what is queued.
+    BLOCK = 3       # Back-pressure: the producer waits for room.
+
+
+class StageQueue(object):
+    def __init__(self, maxsize=2, drop_policy=DropPolicy.DROP_OLDEST, on_drop=None):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.on_drop = on_drop
+        self.dropped = 0
+
+    def put(self, item, running=lambda: True):
+        if self.drop_policy == DropPolicy.BLOCK:
+            while running():
+                try:
+                    self.q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            return
+        try:
+            self.q.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.drop_policy == DropPolicy.DROP_NEWEST:
+            self._drop(item)
+            return
+        try:
+            self._drop(self.q.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            self.q.put_nowait(item)
+        except queue.Full:
+            pass
+
+    def _drop(self, item):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def get(self, timeout=None):
+        return self.q.get(timeout=timeout)
+
+    def depth(self):
+        return self.q.qsize()
+
+    def full(self):
+        return self.q.full()
+
+
+class Stage(object):
+    logger = Logger("Pipeline")
+
+    def __init__(self, name, function, inbox=None, outbox=None):
+        self.name = name
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.errors = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            try:
+                if self.inbox is None:
+                    result = self.function()
+                else:
+                    try:
+                        item = self.inbox.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    result = self.function(item)
+            except Exception:
+                self.errors += 1
+                self.logger.error("Stage '{}' failed:\n{}", self.name, traceback.format_exc())
+                continue
+            if self.outbox is None:
+                self.processed += 1
+            elif result is not None:
+                self.processed += 1
+                self.outbox.put(result, running=lambda: self.running)
+
+    def stats(self):
+        stats = {"processed": self.processed, "errors": self.errors}
+        if self.inbox is not None:
+            stats["queue_depth"] = self.inbox.depth()
+            stats["dropped"] = self.inbox.dropped
+        return stats
+
+
+class FramePipeline(object):
+    # 'encode' may return futures instead of results, in which case 'publish'
+    # resolves them in order; 'futures' lists the futures in an encode result
+    # and 'on_drop' releases dropped ones. A frame is only captured when one
+    # of the 'in_flight' encoders will be free for it (plus one frame read
+    # ahead while they are all busy), so frames aren't decoded just to wait
+    # for the encoder, while capture, encode and publish still overlap. What
+    # waits to be published is bounded by the queues and their drop policy.
+    # Without 'encode', captured items go straight to 'publish'.
+    def __init__(self, capture, encode, publish, config=None, in_flight=1, on_drop=None,
+                 futures=None):
+        config = config or {}
+        queue_size = config.get("queue_size", 2)
+        drop_policy = DropPolicy[config.get("drop_policy", "DROP_OLDEST")]
+        self.futures = futures
+
+        self.publish_queue = StageQueue(max(queue_size, in_flight), drop_policy, on_drop)
+        if encode is None:
+            self.stages = [
+                Stage("capture", capture, outbox=self.publish_queue),
+                Stage("publish", publish, inbox=self.publish_queue),
+            ]
+        else:
+            self.credits = threading.Semaphore(in_flight + 1)
+            self.encode_queue = StageQueue(queue_size, drop_policy,
+                                           lambda item: self.credits.release())
+            self.stages = [
+                Stage("capture", self._gated(capture), outbox=self.encode_queue),
+                Stage("encode", self._releasing(encode), inbox=self.encode_queue,
+                      outbox=self.publish_queue),
+                Stage("publish", publish, inbox=self.publish_queue),
+            ]
+
+    def _gated(self, capture):
+        def gated_capture():
+            if not self.credits.acquire(timeout=0.1):
+                return None
+            try:
+                item = capture()
+            except Exception:
+                self.credits.release()
+                raise
+            if item is None:
+                self.credits.release()
+            return item
+        return gated_capture
+
+    def _releasing(self, encode):
+        # The credit comes back once the frame is encoded (or its encode is
+        # cancelled), not when it is published.
+        def releasing_encode(item):
+            try:
+                result = encode(item)
+            except Exception:
+                self.credits.release()
+                raise
+            pending = self.futures(result) if result is not None and self.futures else []
+            if not pending:
+                self.credits.release()
+                return result
+            remaining = [len(pending)]
+            lock = threading.Lock()
+
+            def done(_):
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self.credits.release()
+            for future in pending:
+                future.add_done_callback(done)
+            return result
+        return releasing_encode
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -0,0 +1,93 @@
+from is_wire.core import Logger
+import time
+
+
+class QualityController(object):
+    logger = Logger("QualityController")
+
+    # Watches what the publish stage sends and, once per 'interval', compares
+    # the bytes per second and the mean publish latency against the targets.
+    # Over target, quality is lowered one 'step' at a time down to
+    # 'min_quality', then the frame is downscaled through 'scales'. Under
+    # 'headroom' times the target, the same steps are undone in reverse.
+    def __init__(self, apply, config=None):
+        config = config or {}
+        self.apply = apply        # (quality factor, scale) -> None
+        self.max_rate = config.get("max_bytes_per_second", 0)
+        self.max_latency = config.get("max_latency", 0)
+        self.min_quality = config.get("min_quality", 0.3)
+        self.step = config.get("step", 0.1)
+        self.scales = config.get("scales", [1.0])
+        self.headroom = config.get("headroom", 0.5)
+        self.interval = config.get("interval", 1.0)
+        self.quality = 1.0
+        self.level = 0
+        self.rate = 0.0
+        self.latency = 0.0
+        self.adjustments = 0
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_frames = 0
+
+    def scale(self):
+        return self.scales[self.level]
+
+    def observe(self, size, latency):
+        self.window_bytes += size
+        self.window_latency += latency
+        self.window_frames += 1
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+        self.rate = self.window_bytes / elapsed
+        self.latency = self.window_latency / self.window_frames
+        self._reset(now)
+
+        load = 0.0
+        if self.max_rate > 0:
+            load = max(load, self.rate / self.max_rate)
+        if self.max_latency > 0:
+            load = max(load, self.latency / self.max_latency)
+        if load > 1.0:
+            changed = self._degrade()
+        elif load < self.headroom:
+            changed = self._recover()
+        else:
+            changed = False
+        if changed:
+            self.adjustments += 1
+            self.logger.info("Load at {:.0%} of target, encoding with quality x{:.2f} and scale {}",
+                             load, self.quality, self.scale())
+            self.apply(self.quality, self.scale())
+
+    def _degrade(self):
+        if self.quality > self.min_quality:
+            self.quality = max(self.min_quality, round(self.quality - self.step, 2))
+        elif self.level + 1 < len(self.scales):
+            self.level += 1
+        else:
+            return False
+        return True
+
+    def _recover(self):
+        if self.level > 0:
+            self.level -= 1
+        elif self.quality < 1.0:
+            self.quality = min(1.0, round(self.quality + self.step, 2))
+        else:
+            return False
+        return True
+
+    def stats(self):
+        return {
+            "quality": self.quality,
+            "scale": self.scale(),
+            "bytes_per_second": int(self.rate),
+            "latency": round(self.latency, 4),
+            "adjustments": self.adjustments,
+        }
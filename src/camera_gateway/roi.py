@@ -0,0 +1,75 @@
+from is_wire.core import Logger
+from is_msgs.image_pb2 import BoundingPoly
+import threading
+import re
+
+NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def box_from_poly(poly):
+    # Bounding box (x0, y0, x1, y1) of the polygon's vertices, in pixels, or
+    # None if it has no area.
+    if len(poly.vertices) < 2:
+        return None
+    xs = [int(round(vertex.x)) for vertex in poly.vertices]
+    ys = [int(round(vertex.y)) for vertex in poly.vertices]
+    x0, y0, x1, y1 = max(0, min(xs)), max(0, min(ys)), max(xs), max(ys)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def poly_from_box(box):
+    x0, y0, x1, y1 = box
+    poly = BoundingPoly()
+    for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1)):
+        vertex = poly.vertices.add()
+        vertex.x, vertex.y = x, y
+    return poly
+
+
+class RegionsOfInterest(object):
+    logger = Logger("RegionsOfInterest")
+
+    # Named regions of the frame, each encoded and published on its own
+    # topic. 'regions' maps names to {"x", "y", "width", "height"} in pixels
+    # and more can be set at runtime; with 'full_frame' false (also settable
+    # at runtime) only the regions are published.
+    def __init__(self, config=None):
+        config = config or {}
+        self.full_frame = config.get("full_frame", True)
+        self.lock = threading.Lock()
+        self.boxes = {}
+        for name, region in config.get("regions", {}).items():
+            self.set(name, (region["x"], region["y"],
+                            region["x"] + region["width"], region["y"] + region["height"]))
+
+    def set(self, name, box):
+        # Copy on write, so crops() never sees a half-updated set.
+        with self.lock:
+            boxes = dict(self.boxes)
+            if box is None:
+                boxes.pop(name, None)
+            else:
+                boxes[name] = tuple(box)
+            self.boxes = boxes
+        self.logger.info("Region '{}' {}.", name, "removed" if box is None else "set to {}".format(box))
+
+    def set_full_frame(self, full_frame):
+        self.full_frame = full_frame
+        self.logger.info("Full frame {}.", "published" if full_frame else "not published")
+
+    def get(self, name):
+        return self.boxes.get(name)
+
+    def names(self):
+        return list(self.boxes)
+
+    def crops(self, frame):
+        # (name, view) for every region, clipped to the frame. The views
+        # share the frame's memory, nothing is copied before encoding.
+        height, width = frame.shape[:2]
+        for name, (x0, y0, x1, y1) in self.boxes.items():
+            x1, y1 = min(x1, width), min(y1, height)
+            if x1 > x0 and y1 > y0:
+                yield name, frame[y0:y1, x0:x1]
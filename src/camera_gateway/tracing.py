@@ -0,0 +1,67 @@
+from opencensus.common import utils
+from datetime import datetime
+import threading
+import random
+import time
+
+
+class AlwaysSampler(object):
+    def sample(self):
+        return True
+
+
+class NeverSampler(object):
+    def sample(self):
+        return False
+
+
+class ProbabilitySampler(object):
+    def __init__(self, rate):
+        self.rate = rate
+
+    def sample(self):
+        return random.random() < self.rate
+
+
+class RateLimitingSampler(object):
+    # At most 'per_second' traces per second, evenly spaced.
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second > 0 else float("inf")
+        self.next_sample = 0.0
+        self.lock = threading.Lock()
+
+    def sample(self):
+        now = time.time()
+        if now < self.next_sample:
+            return False
+        with self.lock:
+            if now < self.next_sample:
+                return False
+            self.next_sample = now + self.interval
+            return True
+
+
+def make_sampler(config=None):
+    # 'sampler' is one of: always (default), never, probability (with
+    # 'rate', 0 to 1) or rate_limit (with 'per_second').
+    config = config or {}
+    sampler = config.get("sampler", "always")
+    if sampler == "never":
+        return NeverSampler()
+    if sampler == "probability":
+        return ProbabilitySampler(config.get("rate", 0.01))
+    if sampler == "rate_limit":
+        return RateLimitingSampler(config.get("per_second", 1.0))
+    return AlwaysSampler()
+
+
+def timestamp(seconds):
+    return utils.to_iso_str(datetime.utcfromtimestamp(seconds))
+
+
+def add_child_span(span, name, start, end):
+    # A finished child span, exported along with 'span'.
+    child = span.span(name)
+    child.start_time = timestamp(start)
+    child.end_time = timestamp(end)
+    return child
@@ -1,7 +1,14 @@
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from camera_driver.encoder import EncoderPool
 from camera_driver.hikvision import HikvisionDriver
+from camera_driver.isapi import new_session
 from camera_gateway.gateway import CameraGateway
+from camera_gateway.host import GatewayHost
+from is_wire.core import Logger
+
+logger = Logger("Service")
 
 
 def main():
@@ -9,12 +16,64 @@ def main():
     config = json.load(open(config_file, 'r'))
 
     broker_uri = config['broker_uri']
-    camera_config = config['camera']
+    zipkin_url = config.get('zipkin_url')
+    metrics_port = config.get('metrics', {}).get('port')
+    tracing_config = config.get('tracing')
+
+    if 'cameras' not in config:
+        camera_config = config['camera']
+        driver = HikvisionDriver(camera_config, zipkin_url=zipkin_url)
+        service = CameraGateway(driver=driver, pipeline=camera_config.get('pipeline'),
+                                adaptive_quality=camera_config.get('adaptive_quality'),
+                                change_detection=camera_config.get('change_detection'),
+                                demand=camera_config.get('demand'),
+                                roi=camera_config.get('roi'),
+                                tracing_config=tracing_config)
+        service.run(broker_uri=broker_uri, metrics_port=metrics_port)
+        return
+
+    # Several cameras in one process, sharing encoder threads, the HTTP pool
+    # and broker connections.
+    cameras = config['cameras']
+    process = config.get('process', {})
+    encoder = EncoderPool(process.get('encoder_workers', 1))
+    session = new_session(pool_size=process.get('isapi_pool_size', 4),
+                          retries=process.get('isapi_retries', 2),
+                          hosts=len(cameras))
+    executor = ThreadPoolExecutor(max_workers=process.get('isapi_pool_size', 4),
+                                  thread_name_prefix="get_config")
+
+    def start_driver(camera_config):
+        # A camera that can't be brought up is left out instead of taking
+        # the others down with it.
+        try:
+            return HikvisionDriver(camera_config, zipkin_url=zipkin_url,
+                                   encoder=encoder, session=session)
+        except Exception as error:
+            logger.error("Camera {} left out, it couldn't be started: {}",
+                         camera_config.get('id'), error)
+            return None
 
-    driver = HikvisionDriver(camera_config, zipkin_url=config.get('zipkin_url'))
+    # Connecting to a camera takes seconds (stream and home position), so
+    # they are brought up together.
+    with ThreadPoolExecutor(max_workers=len(cameras)) as starter:
+        drivers = list(starter.map(start_driver, cameras))
+    if not any(drivers):
+        logger.critical("None of the cameras could be started.")
 
-    service = CameraGateway(driver=driver)
-    service.run(broker_uri=broker_uri)
+    host = GatewayHost(broker_uri, publish_connections=process.get('publish_connections', 1),
+                       stats_interval=process.get('stats_interval', 10.0),
+                       metrics_port=metrics_port, tracing_config=tracing_config)
+    for driver, camera_config in zip(drivers, cameras):
+        if driver is None:
+            continue
+        host.add(CameraGateway(driver=driver, pipeline=camera_config.get('pipeline'),
+                               adaptive_quality=camera_config.get('adaptive_quality'),
+                               change_detection=camera_config.get('change_detection'),
+                               demand=camera_config.get('demand'),
+                               roi=camera_config.get('roi'),
+                               executor=executor, tracing_config=tracing_config))
+    host.run()
 
 if __name__ == "__main__":
     main()